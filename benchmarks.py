@@ -0,0 +1,139 @@
+"""Micro benchmarks for pyquo.
+
+Usage: python benchmarks.py [name ...]
+"""
+import sys
+import timeit
+import tracemalloc
+
+from pyquo.codec import CODECS
+from pyquo.helper import TypeFactory
+from pyquo.models import URL, File
+
+
+def make_records(count):
+    return [{
+        'class': 'fact',
+        'type': 'url',
+        'id': 'http://example-{}.com/path?query={}'.format(i, i),
+        'document': {
+            'netloc': 'example-{}.com'.format(i),
+            'scheme': 'http',
+            'path': '/path',
+            'query': 'query={}'.format(i),
+            'hostname': 'example-{}.com'.format(i),
+        }
+    } for i in range(count)]
+
+
+def bench_codec(count=100000, repeat=3):
+    """Time decoding and encoding of a query response with count records
+    for each installed json codec"""
+    payload = {'records': make_records(count)}
+    print('codec: {} records'.format(count))
+
+    for klass in CODECS:
+        try:
+            codec = klass()
+        except ImportError:
+            print('  {:<12} not installed'.format(klass.name))
+            continue
+
+        data = codec.dumps(payload)
+        decode = min(timeit.repeat(
+            lambda: codec.loads(data), number=1, repeat=repeat))
+        encode = min(timeit.repeat(
+            lambda: codec.dumps(payload), number=1, repeat=repeat))
+        print('  {:<12} decode {:8.1f}ms  encode {:8.1f}ms'.format(
+            codec.name, decode * 1000, encode * 1000))
+
+
+def bench_documents(count=100000, keys=10):
+    """Measure the memory held by count deserialized facts whose documents
+    carry keys schemaless keys with varying names"""
+    records = make_records(count)
+    for i, record in enumerate(records):
+        for j in range(keys):
+            record['document']['attr-{}-{}'.format(i % 5000, j)] = j
+
+    fields = len(URL._fields)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    facts = [TypeFactory.deserialize(record) for record in records]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print('documents: {} records, {} schemaless keys each'.format(
+        len(facts), keys))
+    print('  {:.0f} bytes per fact, {} new class-level fields'.format(
+        (after - before) / float(count), len(URL._fields) - fields))
+
+
+def bench_handles(count=100000):
+    """Measure the memory held by count idle fact handles"""
+    ids = ['{:064x}'.format(i) for i in range(count)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    handles = [File(id=id) for id in ids]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print('handles: {} idle handles'.format(len(handles)))
+    print('  {:.0f} bytes per handle'.format((after - before) / float(count)))
+
+
+def make_cases(count):
+    return [{
+        'class': 'sysfact',
+        'type': 'case',
+        'id': '{:032x}'.format(i),
+        'document': {
+            'name': 'case {}'.format(i),
+            'description': 'description of case {}'.format(i),
+            'priority': 1.0,
+            'flavor': 'case',
+            'type': 'investigation',
+            'created-at': 1570000000.0 + i,
+            'created-by': 'user',
+            'updated-at': 1570000000.0 + i,
+        }
+    } for i in range(count)]
+
+
+def bench_deserialize(count=100000, repeat=3):
+    """Time the deserialization of count url and case records with the
+    default, lazy and trusted deserialization options"""
+    modes = (
+        ('validated', {}),
+        ('lazy', {'lazy_documents': True}),
+        ('trusted', {'trusted': True}),
+    )
+    print('deserialize: {} records'.format(count))
+
+    for kind, records in (('url', make_records(count)),
+                          ('case', make_cases(count))):
+        for mode, options in modes:
+            for name, value in options.items():
+                setattr(TypeFactory, name, value)
+
+            elapsed = min(timeit.repeat(
+                lambda: [TypeFactory.deserialize(r) for r in records],
+                number=1, repeat=repeat))
+
+            TypeFactory.lazy_documents = TypeFactory.trusted = False
+            print('  {:<5} {:<12} {:8.1f}ms'.format(
+                kind, mode, elapsed * 1000))
+
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'deserialize': bench_deserialize,
+    'documents': bench_documents,
+    'handles': bench_handles,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -0,0 +1,291 @@
+import asyncio
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from urllib.parse import urljoin
+except ImportError:
+    from urlparse import urljoin
+
+from .authenticator import UserAuthenticator
+from .codec import JSONCodec, get_codec
+from .errors import AuthenticationError, FetchError
+from .helper import TypeFactory
+from .identity import IdentityMap
+from .session import (
+    Session, CATALOG_QUERY, CATALOG_IMPORT, AUTH_LOGIN,
+    fetch_batches, load_fetched
+)
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def expect(*codes):
+    def wrap(func):
+        async def wrapper(*args, **kwargs):
+            res = await func(*args, **kwargs)
+            if res.status_code not in codes:
+                raise FetchError("unexpected http code <{}> {}".format(
+                    res.status_code, res.content), res.status_code)
+            return res
+        return wrapper
+    return wrap
+
+
+class Response(object):
+    """Buffered response of an AsyncSession request"""
+
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+
+class AsyncSession(object):
+    """ This class is the asyncio counterpart of pyquo.session.Session. It
+        offers the same methods as coroutines and allows many requests to be
+        in flight at once on a single event loop. aiohttp is required.
+
+        >>> async with AsyncSession("https://qlab.quo/", auth=auth) as s:
+        ...     await asyncio.gather(*[f.aget(session=s) for f in facts])
+
+        :param limit: maximum number of concurrent connections
+        :param identity_map_size: see pyquo.session.Session
+        :param lazy_documents: see pyquo.session.Session
+        :param trusted: see pyquo.session.Session
+    """
+    asynchronous = True
+
+    def __init__(self, base_url, verify=True, auth=None, codec=None,
+                 limit=100, identity_map_size=0, lazy_documents=None,
+                 trusted=None):
+        if aiohttp is None:
+            raise ImportError('AsyncSession requires aiohttp')
+
+        self.url = base_url
+        self.verify = verify
+        self.headers = {}
+        if not isinstance(codec, JSONCodec):
+            codec = get_codec(codec)
+        self.codec = codec
+        self.identity_map = IdentityMap(identity_map_size)
+        self.lazy_documents = lazy_documents
+        self.trusted = trusted
+
+        self._auth = auth
+        self._login = None
+        self._limit = limit
+        self._client = None
+
+    # the codec handling is shared with the synchronous session
+    encode = Session.encode
+    decode = Session.decode
+
+    @property
+    def client(self):
+        if self._client is None:
+            connector = aiohttp.TCPConnector(limit=self._limit)
+            self._client = aiohttp.ClientSession(connector=connector)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def __aenter__(self):
+        await self._authenticate()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _authenticate(self):
+        """Authenticate once, concurrent requests wait for the login"""
+        if self._auth is None:
+            return
+
+        if self._login is None:
+            self._login = asyncio.ensure_future(
+                aauthenticate(self._auth, self))
+
+        await self._login
+
+    async def _send(self, method, path, data=None, json=None, headers={}):
+        """Perform a request without authenticating first"""
+        url = urljoin(self.url, path)
+        data, headers = self.encode(data, json, headers)
+        headers = dict(self.headers, **headers)
+        ssl = None if self.verify else False
+
+        logger.debug('%s %s data: %s', method, path, json or data)
+        async with self.client.request(method, url, data=data,
+                                       headers=headers, ssl=ssl) as res:
+            content = await res.read()
+
+        logger.debug('%d: Response %s', res.status, content)
+        return Response(res.status, content, res.headers)
+
+    async def _request(self, method, path, **kwargs):
+        await self._authenticate()
+        return await self._send(method, path, **kwargs)
+
+    async def http_post(self, path, data=None, json=None, headers={}):
+        return await self._request(
+            'POST', path, data=data, json=json, headers=headers)
+
+    async def http_patch(self, path, data=None, json=None, headers={}):
+        return await self._request(
+            'PATCH', path, data=data, json=json, headers=headers)
+
+    async def http_delete(self, path, data=None, json=None, headers={}):
+        return await self._request(
+            'DELETE', path, data=data, json=json, headers=headers)
+
+    async def http_get(self, path):
+        return await self._request('GET', path)
+
+    async def remove(self, query):
+        @expect(200)
+        async def q(self, query):
+            return await self.http_delete(CATALOG_QUERY, json=query)
+        return self.decode(await q(self, query))
+
+    async def _query(self, query):
+        @expect(200)
+        async def q(self, query):
+            return await self.http_post(CATALOG_QUERY, json=query)
+        return self.decode(await q(self, query))['records']
+
+    async def _import(self, query):
+        @expect(200)
+        async def q(self, query):
+            return await self.http_post(CATALOG_IMPORT, json=query)
+        return self.decode(await q(self, query))
+
+    async def _patch(self, query):
+        @expect(200)
+        async def q(self, query):
+            return await self.http_patch(CATALOG_QUERY, json=query)
+        return self.decode(await q(self, query))
+
+    async def fetch(self, objects, chunk_size=None, strict=True):
+        """Awaitable variant of pyquo.session.Session.fetch, the id list
+        queries are sent concurrently"""
+        objects = list(objects)
+        batches = fetch_batches(objects, chunk_size)
+        results = await asyncio.gather(*[
+            self._query(query) for _, query in batches])
+        load_fetched(self, batches, results, strict)
+
+        return objects
+
+    @property
+    def current_user(self):
+        @expect(200)
+        async def q(self):
+            return await self.http_get(AUTH_LOGIN)
+
+        async def user(self):
+            return self.decode(await q(self))['user']['id']
+        return user(self)
+
+
+# The coroutines behind the awaitable methods of the models, querysets and
+# authenticators. They live here so that the core modules, which have to
+# import on python2, do not contain coroutine syntax.
+
+
+async def aauthenticate(auth, session):
+    """Authenticate an AsyncSession using a pyquo.authenticator"""
+    if not isinstance(auth, UserAuthenticator):
+        auth.authenticate(session)
+        return
+
+    path, data = auth._login_request()
+    r = await session._send('POST', path, json=data)
+    if r.status_code != 200:
+        raise AuthenticationError(r.content)
+
+
+async def aget(model, session):
+    records = await session._query(model.serialize)
+    return model._load_records(records, session)
+
+
+async def asave(model, session):
+    res = await session._import({model._class: [model._import_record()]})
+    return model._import_result(res, session)
+
+
+async def aupdate(model, session, patchfields):
+    query = model.serialize
+    query['patch'] = patchfields
+    return await session._patch(query)
+
+
+async def adelete(model, session):
+    return await session.remove({'query': model.serialize})
+
+
+async def afilter(filter, session, target, source, fact, document, kwargs):
+    query = filter._build(
+        filter._type, filter._class, document,
+        **filter._relations(target, source, fact, kwargs))
+    results = await session._query(query)
+
+    return [TypeFactory.deserialize(r, session) for r in results]
+
+
+async def areferences(fact, limit, refs=(), facts=(), incoming=False,
+                      session=None, offset=0):
+    """Awaitable variant of BaseFact._references. The reference classes are
+    queried concurrently, hence the offset of several reference classes is
+    applied locally"""
+    if len(refs) == 1:
+        windows, skip = [(limit, offset)], 0
+    else:
+        window = (None if limit is None else offset + limit, 0)
+        windows, skip = [window] * len(refs), offset
+
+    batches = await asyncio.gather(*[
+        session._query(fact._references_query(
+            ref, facts, incoming, *window))
+        for ref, window in zip(refs, windows)
+    ])
+
+    results = [
+        fact._reference_item(ref, item, session)
+        for ref, references in zip(refs, batches)
+        for item in references
+    ]
+    end = None if limit is None else skip + limit
+    return results[skip:end]
+
+
+async def aannotations(fact, annotations, limit, session=None, offset=0):
+    query = fact._annotations_query(annotations, limit, offset)
+    records = await session._query(query)
+    return [TypeFactory.deserialize(item, session) for item in records]
+
+
+async def aiter_queryset(queryset):
+    """Iterate over a queryset, see QuerySet.__aiter__"""
+    results = queryset._result_cache
+    if results is None:
+        results = tuple(await queryset._afetch())
+        if queryset._prefetch:
+            facts = queryset._unfetched(results)
+            if facts:
+                await queryset._fetch_session().fetch(facts, strict=False)
+
+        if queryset._cache:
+            queryset._result_cache = results
+
+    for item in results:
+        yield queryset._target(item)
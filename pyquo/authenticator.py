@@ -20,7 +20,7 @@ class TokenAuthenticator(Authenticator):
         """This method returns a session id"""
 
         info = {"expires-in": expires_in}
-        res = session.http_post(AUTH_API, json=info).json()
+        res = session.decode(session.http_post(AUTH_API, json=info))
         return res
 
     def authenticate(self, session):
@@ -39,12 +39,16 @@ class UserAuthenticator(Authenticator):
         self._username = username
         self._password = password
 
-    def authenticate(self, session):
+    def _login_request(self):
         data = {
             'username': self._username,
             'password': self._password
         }
         path = "/v1/auth/login"
+        return path, data
+
+    def authenticate(self, session):
+        path, data = self._login_request()
 
         r = session.http_post(path, json=data)
         if r.status_code != 200:
@@ -7,26 +7,38 @@ from .helper import (
     FACT_CLASS, ANNOTATION_CLASS, SYSFACT_CLASS, REFERENCE_CLASS, SYSREF_CLASS
 )
 from .session import Filter
-from .errors import ValidationError, RequiredError, ResultNotFound
+from .graph import graph_store, traverse
+from .errors import (
+    ValidationError, RequiredError, ResultNotFound, SessionError
+)
 from .fields import Field
 
 from six import with_metaclass
 
 
 class QuerySet(object):
+    """QuerySets are evaluated lazily. The results of the first evaluation are
+    cached and reused by subsequent calls to __len__, __iter__, __getitem__
+    and __repr__ until the query parameters change or refresh() is called.
+    """
     _parent = None
 
-    def __init__(self, parent, refs=(), facts=(),
-                 incoming=False, limit=None, session=None):
+    def __init__(self, parent, refs=(), facts=(), incoming=False,
+                 limit=None, session=None, cache=True, prefetch=False):
         self._parent = parent
         self._references = refs or (SysRef, Reference)
         self._facts = facts
         self._incoming = incoming
         self._limit = limit
         self._session = session
+        self._cache = cache
+        self._prefetch = prefetch
+        self._result_cache = None
 
     def __call__(self, refs=(), facts=(), annotations=(),
-                 incoming=None, limit=None, session=None):
+                 incoming=None, limit=None, session=None, prefetch=None):
+        params = self._params()
+
         if not isinstance(facts, Iterable):
             facts = (facts,)
         self._facts = facts
@@ -44,22 +56,107 @@ class QuerySet(object):
         if session is not None:
             self._session = session
 
+        if prefetch is not None:
+            self._prefetch = prefetch
+
+        if self._params() != params:
+            self._result_cache = None
+
+        return self
+
+    def _params(self):
+        return (tuple(self._references), tuple(self._facts), self._incoming,
+                self._limit, self._session, self._prefetch)
+
+    def cache(self, enabled=True):
+        """Enable or disable the caching of query results. A disabled cache
+        bypasses the graph store of the session as well"""
+        self._cache = enabled
+        if not enabled:
+            self._result_cache = None
+        return self
+
+    def refresh(self):
+        """Drop the cached results and the references of the parent held by
+        the graph store, the next access queries the server"""
+        self._result_cache = None
+
+        store = graph_store(self._session or self._parent._session)
+        if store is not None:
+            store.invalidate(self._parent)
+
         return self
 
     def query(self, key=None):
+        if self._result_cache is not None:
+            return self._result_cache
+
+        results = self._fetch()
+        if self._cache:
+            self._result_cache = results
+
+        return results
+
+    def _fetch(self, offset=0, limit=None):
         results = self._parent._references(
             refs=self._references,
             facts=self._facts,
             incoming=self._incoming,
-            limit=self._limit,
-            session=self._session
+            limit=self._limit if limit is None else limit,
+            offset=offset,
+            session=self._session,
+            use_store=self._cache
         )
+        results = tuple(results)
+
+        if self._prefetch:
+            self._prefetch_related(results)
+
+        return results
+
+    def _window(self, key):
+        """Translate an index or a slice into an (offset, limit) tuple which
+        can be passed on to the server. Returns None for negative indexes and
+        steps, which require the entire result set"""
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                return None
+            start, stop = key.start or 0, key.stop
+        elif isinstance(key, int):
+            start, stop = key, key + 1
+        else:
+            return None
+
+        if start < 0 or (stop is not None and stop < 0):
+            return None
+
+        if self._limit is not None:
+            stop = self._limit if stop is None else min(stop, self._limit)
 
-        return tuple(results)
+        if stop is None:
+            return start, None
+
+        return start, max(stop - start, 0)
 
     def __getitem__(self, key):
-        results = self.query(key)
-        return [self._target(result) for result in results][key]
+        window = None
+        if self._result_cache is None:
+            window = self._window(key)
+
+        if window is None:
+            results = self.query(key)
+            return [self._target(result) for result in results][key]
+
+        offset, limit = window
+        results = self._fetch(offset, limit) if limit != 0 else ()
+
+        if isinstance(key, slice):
+            return [self._target(result) for result in results]
+
+        if not results:
+            raise IndexError('QuerySet index out of range')
+
+        return self._target(results[0])
 
     def __iter__(self):
         for item in self.query():
@@ -68,6 +165,19 @@ class QuerySet(object):
     def __len__(self):
         return len(self.query())
 
+    def __aiter__(self):
+        from .aio import aiter_queryset
+        return aiter_queryset(self)
+
+    def _afetch(self):
+        return self._parent._areferences(
+            refs=self._references,
+            facts=self._facts,
+            incoming=self._incoming,
+            limit=self._limit,
+            session=self._session
+        )
+
     def __repr__(self):
         result = list(self[:4])
         if len(result) > 3:
@@ -75,23 +185,75 @@ class QuerySet(object):
         return 'QuerySet{}'.format(str(result))
 
 
-class ReferenceQuerySet(QuerySet):
+class RelationQuerySet(QuerySet):
+    """Base class of the querysets of references and of the facts they
+    lead to"""
+
+    def select_related(self, enabled=True):
+        """Fetch the documents of the source and target facts along with the
+        references, using batched id list queries"""
+        return self(refs=self._references, facts=self._facts,
+                    prefetch=enabled)
+
+    def _prefetch_related(self, references):
+        facts = self._unfetched(references)
+        if facts:
+            self._fetch_session().fetch(facts, strict=False)
+
+    @staticmethod
+    def _unfetched(references):
+        return [
+            fact
+            for reference in references
+            for fact in (reference.source, reference.target)
+            if not fact._fetched
+        ]
+
+    def _fetch_session(self):
+        session = self._session or self._parent._session
+        if session is None:
+            raise SessionError("No session provided")
+        return session
+
+
+class ReferenceQuerySet(RelationQuerySet):
     @property
     def facts(self):
-        return FactQuerySet(
-            parent=self._parent,
-            refs=self._references,
-            facts=self._facts,
-            incoming=self._incoming,
-            limit=self._limit,
-            session=self._session
-        )
+        return FactQuerySet(self)
 
     def _target(self, item):
         return item
 
 
-class FactQuerySet(QuerySet):
+def _shared(name):
+    """Property delegating the attribute name to the reference queryset"""
+    def get(self):
+        return getattr(self._queryset, name)
+
+    def set(self, value):
+        setattr(self._queryset, name, value)
+
+    return property(get, set)
+
+
+class FactQuerySet(RelationQuerySet):
+    """This queryset yields the facts at the other end of the references of
+    a ReferenceQuerySet. It shares the parameters and the cached results of
+    the reference queryset, calling refresh() or cache() on either applies
+    to both"""
+    _parent = _shared('_parent')
+    _references = _shared('_references')
+    _facts = _shared('_facts')
+    _incoming = _shared('_incoming')
+    _limit = _shared('_limit')
+    _session = _shared('_session')
+    _cache = _shared('_cache')
+    _prefetch = _shared('_prefetch')
+    _result_cache = _shared('_result_cache')
+
+    def __init__(self, queryset):
+        self._queryset = queryset
+
     def _target(self, item):
         if self._incoming is False:
             return item.target
@@ -101,13 +263,15 @@ class FactQuerySet(QuerySet):
 
 class AnnotationQuerySet(QuerySet):
     def __init__(self, *args, **kwargs):
-        self._annotations = kwargs.get('annotations')
+        self._annotations = kwargs.pop('annotations', None)
         super(AnnotationQuerySet, self).__init__(*args, **kwargs)
 
     def _target(self, item):
         return item
 
     def __call__(self, annotations=(), limit=None, session=None):
+        params = self._params()
+
         if not isinstance(annotations, Iterable):
             annotations = (annotations,)
         self._annotations = annotations
@@ -118,15 +282,29 @@ class AnnotationQuerySet(QuerySet):
         if session is not None:
             self._session = session
 
+        if self._params() != params:
+            self._result_cache = None
+
         return self
 
-    def query(self, key=None):
+    def _params(self):
+        return tuple(self._annotations or ()), self._limit, self._session
+
+    def _fetch(self, offset=0, limit=None):
         return tuple(self._parent._annotations(
-            limit=self._limit,
+            limit=self._limit if limit is None else limit,
+            offset=offset,
             annotations=self._annotations,
             session=self._session
         ))
 
+    def _afetch(self):
+        return self._parent._aannotations(
+            limit=self._limit,
+            annotations=self._annotations,
+            session=self._session
+        )
+
 
 class ModelMetaClass(type):
     """This class adds the '_fields' attribute which corresponds to a
@@ -160,6 +338,10 @@ class Model(with_metaclass(ModelMetaClass)):
     _class = None
     _type = None
     _session = None
+    _fetched = False
+    _document = None
+    _pending = False
+    _trusted = False
 
     def __init__(self, document=None, session=None, **kwargs):
         self._data = dict()
@@ -176,12 +358,22 @@ class Model(with_metaclass(ModelMetaClass)):
         or using the session provided by the instance. If no session is
         available this method raises a SessionError"""
 
-        query = self.serialize
-        records = session._query(query)
+        records = session._query(self.serialize)
+        return self._load_records(records, session)
+
+    @sessionize
+    def aget(self, session=None):
+        """Awaitable variant of get, requires a pyquo.aio.AsyncSession"""
+        from .aio import aget
+        return aget(self, session)
+
+    def _load_records(self, records, session):
         if not records:
             raise ResultNotFound('Result not found for {}'.format(self))
 
-        self.document = records[0]['document']
+        self._load_document(records[0]['document'],
+                            trusted=TypeFactory._option(session, 'trusted'))
+        self._fetched = True
 
         return self
 
@@ -191,6 +383,36 @@ class Model(with_metaclass(ModelMetaClass)):
         or using the session provided by the instance. If no session is
         available this method raises a SessionError"""
 
+        res = session._import({self._class: [self._import_record()]})
+        self._invalidate(session)
+        return self._import_result(res, session)
+
+    @sessionize
+    def asave(self, session=None):
+        """Awaitable variant of save, requires a pyquo.aio.AsyncSession"""
+        from .aio import asave
+        return asave(self, session)
+
+    def _import_result(self, res, session):
+        cl = self._class
+        res = res.get(cl)[0]
+        res.setdefault('class', cl)
+        return TypeFactory.deserialize(res, session)
+
+    @classmethod
+    @sessionize
+    def save_many(cls, objects, chunk_size=None, session=None):
+        """This method stores many objects using as few import requests as
+        possible. See Session.bulk_import"""
+        return session.bulk_import(objects, chunk_size=chunk_size)
+
+    def _import_record(self):
+        """This method checks the required fields, copies the field values
+        into the document and returns the record expected by the import
+        endpoint"""
+        if self._pending:
+            self._materialize()
+
         for key, field in self._fields.items():
             if field.required and field not in self._data:
                 raise RequiredError('Required field "{}" missing {}'.format(
@@ -202,13 +424,7 @@ class Model(with_metaclass(ModelMetaClass)):
             if field in self._data:
                 self.document[key] = self._data[field]
 
-        serialized = self.serialize_with_document
-        cl = serialized.pop('class')
-        query = {self._class: [self.serialize_with_document]}
-        res = session._import(query)
-        res = res.get(cl)[0]
-        res.setdefault('class', cl)
-        return TypeFactory.deserialize(res)
+        return self.serialize_with_document
 
     @sessionize
     def update(self, session=None, **patchfields):
@@ -216,16 +432,44 @@ class Model(with_metaclass(ModelMetaClass)):
         query['patch'] = patchfields
         return session._patch(query)
 
+    @sessionize
+    def aupdate(self, session=None, **patchfields):
+        """Awaitable variant of update"""
+        from .aio import aupdate
+        return aupdate(self, session, patchfields)
+
     @sessionize
     def delete(self, session=None):
         """This method deletes an object using the api"""
-        return session.remove({'query': self.serialize})
+        res = session.remove({'query': self.serialize})
+        self._invalidate(session)
+        return res
+
+    def _invalidate(self, session):
+        """Drop the references concerning this object from the graph store
+        of the session, see pyquo.graph.GraphStore"""
+        pass
+
+    @sessionize
+    def adelete(self, session=None):
+        """Awaitable variant of delete"""
+        from .aio import adelete
+        return adelete(self, session)
 
     @classmethod
     @sessionize
     def filter(self, target=None, source=None, fact=None,
-               document=None, session=None, **kwargs):
-        return self._filter(target, source, fact, document, session, **kwargs)
+               document=None, session=None, stream=False, **kwargs):
+        return self._filter(target, source, fact, document, session,
+                            stream=stream, **kwargs)
+
+    @classmethod
+    @sessionize
+    def afilter(self, target=None, source=None, fact=None,
+                document=None, session=None, **kwargs):
+        """Awaitable variant of filter"""
+        return self._filter.acall(
+            target, source, fact, document, session, **kwargs)
 
     def resolve_name(self, key):
         """This method resolves field names. E.g.
@@ -236,21 +480,45 @@ class Model(with_metaclass(ModelMetaClass)):
 
     @property
     def document(self):
+        if self._document is None:
+            self._document = {}
         return self._document
 
     @document.setter
     def document(self, document):
-        if document is None:
-            document = {}
+        self._load_document(document)
+
+    def _load_document(self, document, lazy=False, trusted=False):
+        """Store the document and assign its values to the fields. If lazy
+        is True the fields are only assigned once the first field is read or
+        written, validation errors are raised at that point. If trusted is
+        True the values are assigned without running the validators"""
+        # handles without document do not allocate one until it is accessed
         self._document = document
+        self._pending = lazy and bool(document)
+        if self._pending:
+            self._trusted = trusted
+        if document is None or self._pending:
+            return
+
+        self._assign(document, trusted)
 
+    def _materialize(self):
+        self._pending = False
+        self._assign(self._document, self._trusted)
+
+    def _assign(self, document, trusted=False):
         for key, value in document.items():
             name = self.resolve_name(key)
 
-            if name not in self._fields:
-                field = Field(value)
-                self._fields[name] = field
-                setattr(self, name, field)
+            field = self._fields.get(name)
+            if field is None:
+                # schemaless keys are read from the document, see __getattr__
+                continue
+
+            if trusted:
+                field.load(self, value)
+                continue
 
             try:
                 setattr(self, name, value)
@@ -258,9 +526,19 @@ class Model(with_metaclass(ModelMetaClass)):
                 raise ValidationError("{} has no field {}={}".format(
                     self._type, name, value))
 
+    def __getattr__(self, name):
+        """Document keys without a field are available as attributes. This
+        method is only called if the regular attribute lookup fails"""
+        document = self.__dict__.get('_document')
+        if document is not None and name in document:
+            return document[name]
+
+        raise AttributeError("'{}' object has no attribute '{}'".format(
+            type(self).__name__, name))
+
     @classmethod
-    def deserialize(self, payload):
-        return TypeFactory.deserialize(payload)
+    def deserialize(self, payload, session=None):
+        return TypeFactory.deserialize(payload, session)
 
     @property
     def serialize_with_document(self):
@@ -278,25 +556,44 @@ class BaseFact(Model):
     save the field values to and from the api"""
 
     _id = None
+    _reference_queryset = None
 
     def __init__(self, id, document=None, session=None, **kwargs):
         super(BaseFact, self).__init__(
             session=session, document=document, **kwargs)
 
         self.id = id
-        self.__references = ReferenceQuerySet(
-            self, session=session or self._session)
 
-    def get_references(self, ref, facts, incoming=True, session=None):
+    @classmethod
+    @sessionize
+    def get_many(cls, ids, session=None, strict=True):
+        """This method fetches many facts of this type using batched id list
+        queries. See Session.fetch"""
+        objects = [cls(id=id, session=session) for id in ids]
+        return session.fetch(objects, strict=strict)
+
+    def get_references(self, ref, facts, incoming=True, session=None,
+                       limit=None, offset=0):
         """This function retrieves references"""
+        query = self._references_query(ref, facts, incoming, limit, offset)
+        return session._query(query)
+
+    def _references_query(self, ref, facts, incoming, limit=None, offset=0):
+        return self._build_references_query(
+            self.serialize, ref, facts, incoming, limit, offset)
 
+    @staticmethod
+    def _build_references_query(anchor, ref, facts, incoming, limit=None,
+                                offset=0):
+        """Build the query of the references of anchor, which is a
+        serialized fact or a list of serialized facts"""
         query = {"class": ref._class}
 
         key, ikey = 'target', 'source'
         if not incoming:
             key, ikey = 'source', 'target'
 
-        query[key] = self.serialize
+        query[key] = anchor
 
         if ref._type:
             query['type'] = ref._type
@@ -310,35 +607,145 @@ class BaseFact(Model):
             if len(query[ikey]) == 1:
                 query[ikey] = q
 
-        return session._query(query)
+        if limit is not None:
+            query['limit'] = limit
+
+        if offset:
+            query['offset'] = offset
+
+        return query
 
     @sessionize
     def _references(self, limit, refs=(), facts=(),
-                    incoming=False, session=None):
+                    incoming=False, session=None, offset=0, use_store=True):
+        store = graph_store(session)
+        if store is not None and use_store:
+            stored = self._stored_references(store, refs, facts, incoming)
+            if stored is not None:
+                end = None if limit is None else offset + limit
+                for reference in stored[offset:end]:
+                    yield reference
+                return
+
+        remaining, skip = limit, offset
+
         for ref in refs:
+            if remaining is not None and remaining <= 0:
+                break
+
+            if len(refs) == 1:
+                window = {'limit': remaining, 'offset': skip}
+                skip = 0
+            else:
+                # the offset spans several queries, it can only be applied
+                # locally but the number of fetched records is still bound
+                window = {'limit': None if remaining is None
+                          else skip + remaining}
+
             references = self.get_references(
-                ref=ref, facts=facts, incoming=incoming, session=session)
+                ref=ref, facts=facts, incoming=incoming, session=session,
+                **window)
 
-            base = Fact if ref == Reference else SysFact
+            # the complete references of an unbound query are stored
+            loaded = None
+            if store is not None and not facts and \
+                    window['limit'] is None and not window.get('offset'):
+                loaded = []
 
             for item in references:
-                # XXX remove once this has been implementd serverside
-                item['target'].setdefault('class', base._class)
-                item['source'].setdefault('class', base._class)
+                reference = self._reference_item(ref, item, session)
+                if loaded is not None:
+                    loaded.append(reference)
+
+                if skip:
+                    skip -= 1
+                    continue
+
+                if remaining is not None:
+                    if remaining <= 0:
+                        break
+                    remaining -= 1
+
+                yield reference
+
+            if loaded is not None:
+                store.put(self, ref, incoming, loaded)
+
+    def _stored_references(self, store, refs, facts, incoming):
+        """Return the references from the graph store, or None unless all
+        of them are stored"""
+        results = []
+        for ref in refs:
+            references = store.get(self, ref, incoming)
+            if references is None:
+                return None
+            results.extend(references)
+
+        if facts:
+            types = set((fact._class, fact._type) for fact in facts)
+            results = [
+                reference for reference in results
+                if self._far_end(reference, incoming) in types
+            ]
+
+        return results
+
+    @staticmethod
+    def _far_end(reference, incoming):
+        fact = reference.source if incoming else reference.target
+        return fact._class, fact._type
+
+    def _invalidate(self, session):
+        store = graph_store(session)
+        if store is not None:
+            store.invalidate(self)
+
+    @sessionize
+    def _areferences(self, limit, refs=(), facts=(),
+                     incoming=False, session=None, offset=0):
+        """Awaitable variant of _references, see pyquo.aio.areferences"""
+        from .aio import areferences
+        return areferences(self, limit, refs, facts, incoming, session,
+                           offset)
+
+    @staticmethod
+    def _reference_item(ref, item, session):
+        base = Fact if ref == Reference else SysFact
 
-                yield TypeFactory.deserialize(item)
+        # XXX remove once this has been implementd serverside
+        item['target'].setdefault('class', base._class)
+        item['source'].setdefault('class', base._class)
+
+        return TypeFactory.deserialize(item, session)
 
     @property
     def references(self):
-        return self.__references
+        """The reference queryset is created on first access, so that idle
+        handles do not carry it"""
+        if self._reference_queryset is None:
+            self._reference_queryset = ReferenceQuerySet(
+                self, session=self._session)
+        return self._reference_queryset
+
+    @sessionize
+    def traverse(self, depth=1, refs=(), facts=(), incoming=False,
+                 max_fanout=None, chunk_size=None, session=None):
+        """This method returns the pyquo.graph.Subgraph of the facts up to
+        depth hops away. Each level is expanded using batched queries, see
+        pyquo.graph.traverse
+
+        >>> fact.traverse(depth=3, refs=[Reference], facts=[URL, Hostname])
+        """
+        return traverse(self, depth, refs or (SysRef, Reference), facts,
+                        incoming, max_fanout, chunk_size, session)
 
     @property
     def descendants(self):
-        return self.__references(incoming=False).facts
+        return self.references(incoming=False).facts
 
     @property
     def ancestors(self):
-        return self.__references(incoming=True).facts
+        return self.references(incoming=True).facts
 
     @property
     def serialize(self):
@@ -394,6 +801,12 @@ class BaseReference(Model):
     def __repr__(self):
         return "{.source}→{._type}→{.target}".format(self, self, self)
 
+    def _invalidate(self, session):
+        store = graph_store(session)
+        if store is not None:
+            store.invalidate(self.source)
+            store.invalidate(self.target)
+
     def __eq__(self, obj):
         try:
             # XXX check indexed field?
@@ -410,20 +823,28 @@ class BaseReference(Model):
 class Fact(BaseFact):
     """Fact Model"""
     _class = FACT_CLASS
-
-    def __init__(self, id, document=None, session=None, **kwargs):
-        super(Fact, self).__init__(
-            id, session=session, document=document, **kwargs)
-
-        self.__annotations = AnnotationQuerySet(
-            self, session=session or self._session)
+    _annotation_queryset = None
 
     @property
     def annotations(self):
-        return self.__annotations
+        if self._annotation_queryset is None:
+            self._annotation_queryset = AnnotationQuerySet(
+                self, session=self._session)
+        return self._annotation_queryset
+
+    @sessionize
+    def _annotations(self, annotations, limit, session=None, offset=0):
+        query = self._annotations_query(annotations, limit, offset)
+
+        for item in session._query(query):
+            yield TypeFactory.deserialize(item, session)
 
     @sessionize
-    def _annotations(self, annotations, limit, session=None):
+    def _aannotations(self, annotations, limit, session=None, offset=0):
+        from .aio import aannotations
+        return aannotations(self, annotations, limit, session, offset)
+
+    def _annotations_query(self, annotations, limit, offset=0):
         queries = []
         query = {"query": queries}
 
@@ -440,8 +861,10 @@ class Fact(BaseFact):
         if limit is not None:
             query['limit'] = limit
 
-        for item in session._query(query):
-            yield TypeFactory.deserialize(item)
+        if offset:
+            query['offset'] = offset
+
+        return query
 
     def __repr__(self):
         return '{._type}({.id})'.format(self, self)
@@ -0,0 +1,80 @@
+import json
+
+
+class JSONCodec(object):
+    """Codec based on the json module of the standard library. All codecs
+    encode to utf-8 encoded bytes and decode from bytes or strings"""
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    """Codec based on orjson"""
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj):
+        return self._orjson.dumps(obj)
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+class UjsonCodec(JSONCodec):
+    """Codec based on ujson"""
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+
+class SimplejsonCodec(JSONCodec):
+    """Codec based on simplejson"""
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self._simplejson = simplejson
+
+    def dumps(self, obj):
+        return self._simplejson.dumps(obj).encode('utf-8')
+
+    def loads(self, data):
+        return self._simplejson.loads(data)
+
+
+# ordered by preference
+CODECS = (OrjsonCodec, UjsonCodec, SimplejsonCodec, JSONCodec)
+
+
+def get_codec(name=None):
+    """Return an instance of the codec with the given name. If no name is
+    given the fastest codec which is installed is returned"""
+    for codec in CODECS:
+        if name is not None and codec.name != name:
+            continue
+
+        try:
+            return codec()
+        except ImportError:
+            if name is not None:
+                raise
+
+    raise ValueError('unknown codec {}'.format(name))
@@ -0,0 +1,70 @@
+import threading
+import zlib
+
+# request bodies smaller than this are not worth compressing
+COMPRESS_THRESHOLD = 1024
+
+# zlib window bits selecting the container of each content encoding
+ENCODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+def compress(data, encoding='gzip', level=6):
+    """Compress data using the given content encoding"""
+    try:
+        wbits = ENCODINGS[encoding]
+    except KeyError:
+        raise ValueError('unknown content encoding {}'.format(encoding))
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+class TransferStats(object):
+    """This class counts the bytes a session transfers, both as sent over
+    the wire and before compression, resp. after decompression. Streamed
+    responses are not counted.
+
+    >>> session.stats.sent, session.stats.sent_uncompressed
+    >>> session.stats.received, session.stats.received_uncompressed
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.sent = 0
+        self.sent_uncompressed = 0
+        self.received = 0
+        self.received_uncompressed = 0
+        self._lock = threading.Lock()
+
+    def add_request(self, sent, uncompressed):
+        with self._lock:
+            self.requests += 1
+            self.sent += sent
+            self.sent_uncompressed += uncompressed
+
+    def add_response(self, res):
+        uncompressed = len(res.content)
+        try:
+            received = res.raw.tell()
+        except AttributeError:
+            received = None
+        if not isinstance(received, int):
+            received = uncompressed
+
+        with self._lock:
+            self.received += received
+            self.received_uncompressed += uncompressed
+
+    @property
+    def saved(self):
+        """Number of bytes compression saved in both directions"""
+        return (self.sent_uncompressed - self.sent +
+                self.received_uncompressed - self.received)
+
+    def reset(self):
+        with self._lock:
+            self.requests = self.sent = self.sent_uncompressed = 0
+            self.received = self.received_uncompressed = 0
@@ -8,6 +8,11 @@ class FetchError(Exception):
         self.status_code = status_code
 
 
+class ChecksumError(FetchError):
+    """Raised when downloaded content does not match its hash"""
+    pass
+
+
 class SessionError(Exception):
     """Raised when no session could be found"""
     pass
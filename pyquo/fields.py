@@ -118,14 +118,19 @@ class Field(object):
         """Get a property using lazy fetching of the entire object if a value
         of the requested property is not cached in the _data field of the model
         instance. Otherwise the cached value is returned from _data. If lazy a
-        lazy fetch is performed all cached values will be overwritten"""
+        lazy fetch is performed all cached values will be overwritten. Objects
+        which have already been fetched are not fetched again"""
 
         if parent is None:
             return self
 
+        if parent._pending:
+            parent._materialize()
+
         """lazy fetching"""
-        if self not in parent._data:
-            if parent._session:
+        if self not in parent._data and not parent._fetched:
+            session = parent._session
+            if session and getattr(session, 'asynchronous', False) is not True:
                 parent.get()
 
         return parent._data.get(self, Unset)
@@ -133,6 +138,9 @@ class Field(object):
     def __set__(self, parent, value):
         """Store value of a given property into the _data field of the model
         instance and trigger validators"""
+        if parent._pending:
+            parent._materialize()
+
         if value is None and self.nullable is True:
             parent._data[self] = None
             return
@@ -140,6 +148,10 @@ class Field(object):
         self.validate(value)
         parent._data[self] = value
 
+    def load(self, parent, value):
+        """Store a value received from the server without validating it"""
+        parent._data[self] = value
+
     @classmethod
     def _resolve(cls, glob):
         """Allow resolves of class names as string references. Fields
@@ -199,6 +211,12 @@ class Relation(Field):
             validators=(DictValidator(),), *args, **kwargs)
 
     def __set__(self, parent, value):
+        if parent._pending:
+            parent._materialize()
+
+        self.load(parent, value)
+
+    def load(self, parent, value):
         from .models import Model
 
         if isinstance(value, Model):
@@ -229,6 +247,12 @@ class List(Field):
 
         super(List, self).__set__(parent, value)
 
+    def load(self, parent, value):
+        if self.type and value is not None:
+            value = [self.type(parent._session, **v) for v in value]
+
+        parent._data[self] = value
+
     def _resolve(self, typ):
         self.validators = (ListValidator(typ),)
         self.type = typ
@@ -0,0 +1,257 @@
+import threading
+from collections import OrderedDict
+
+try:
+    from time import monotonic
+except ImportError:
+    # python2
+    from time import time as monotonic
+
+from .session import FETCH_CHUNK_SIZE
+
+
+class Subgraph(object):
+    """This class holds the facts and references found by a traversal.
+    levels[n] lists the facts first reached after n hops, levels[0] being
+    the root. truncated is True if references were dropped because of the
+    fan-out cap.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.levels = [[root]]
+        self.references = []
+        self.truncated = False
+        self.queries = 0
+        self._depths = {root: 0}
+        self._references = set()
+
+    @property
+    def facts(self):
+        return [fact for level in self.levels for fact in level]
+
+    def depth(self, fact):
+        """Return the number of hops between the root and fact"""
+        return self._depths[fact]
+
+    def _add(self, fact, depth):
+        if fact in self._depths:
+            return False
+
+        self._depths[fact] = depth
+        self.levels[depth].append(fact)
+        return True
+
+    def __contains__(self, fact):
+        return fact in self._depths
+
+    def __len__(self):
+        return len(self._depths)
+
+    def __repr__(self):
+        return '<Subgraph {} facts, {} references>'.format(
+            len(self), len(self.references))
+
+
+def _directions(incoming):
+    if incoming is None:
+        return (False, True)
+    return (incoming,)
+
+
+def traverse(root, depth, refs, facts=(), incoming=False, max_fanout=None,
+             chunk_size=None, session=None):
+    """Expand the references of root breadth first, level by level. The
+    whole frontier of a level is queried at once using id list queries of
+    up to chunk_size facts per reference class and direction, hence the
+    number of queries grows with depth rather than with the number of facts.
+    Facts are visited once.
+
+    :param incoming: follow incoming (True), outgoing (False) or both (None)
+        references
+    :param max_fanout: maximum number of references followed per fact,
+        reference class and direction. All references of the frontier are
+        fetched, the cap only applies to the facts added to the subgraph
+    """
+    chunk_size = chunk_size or FETCH_CHUNK_SIZE
+    subgraph = Subgraph(root)
+
+    for level in range(1, depth + 1):
+        frontier = subgraph.levels[-1]
+        if not frontier:
+            break
+
+        subgraph.levels.append([])
+        for ref in refs:
+            for inbound in _directions(incoming):
+                for offset in range(0, len(frontier), chunk_size):
+                    chunk = frontier[offset:offset + chunk_size]
+                    _expand(root, ref, chunk, facts, inbound, max_fanout,
+                            session, subgraph, level)
+
+    # drop the empty level of a frontier without references
+    while len(subgraph.levels) > 1 and not subgraph.levels[-1]:
+        subgraph.levels.pop()
+
+    return subgraph
+
+
+def _expand(root, ref, chunk, facts, incoming, max_fanout, session,
+            subgraph, level):
+    anchor = [fact.serialize for fact in chunk]
+    if len(anchor) == 1:
+        anchor = anchor[0]
+
+    # the server cannot cap the references per fact, a limit on the chunk
+    # lets a single hub use it up, so the fan-out is capped locally
+    query = root._build_references_query(anchor, ref, facts, incoming, None)
+
+    records = session._query(query)
+    subgraph.queries += 1
+
+    # the complete references of the chunk are stored
+    store = graph_store(session)
+    loaded = None
+    if store is not None and not facts:
+        loaded = dict((fact, []) for fact in chunk)
+
+    fanout = {}
+    for item in records:
+        reference = root._reference_item(ref, item, session)
+        near, far = reference.source, reference.target
+        if incoming:
+            near, far = far, near
+
+        if loaded is not None and near in loaded:
+            loaded[near].append(reference)
+
+        if max_fanout is not None:
+            fanout[near] = fanout.get(near, 0) + 1
+            if fanout[near] > max_fanout:
+                subgraph.truncated = True
+                continue
+
+        if reference in subgraph._references:
+            # found following both directions
+            continue
+
+        subgraph._references.add(reference)
+        subgraph.references.append(reference)
+        subgraph._add(far, level)
+
+    for fact, references in (loaded or {}).items():
+        store.put(fact, ref, incoming, references)
+
+
+def graph_store(session):
+    """Return the graph store of the session or None"""
+    store = getattr(session, 'graph_store', None)
+    if isinstance(store, GraphStore):
+        return store
+
+
+class GraphStore(object):
+    """This class is a local index of references by source, by target and
+    by reference class and type. A session with a graph store answers
+    fact.references(), fact.ancestors and fact.descendants from the store
+    once the references in question were loaded completely, i.e. by a query
+    without limit and fact filter or by fact.traverse without fact filter.
+    Loaded references are fresh for ttl seconds. Saving or
+    deleting references and facts through the session invalidates the
+    facts concerned.
+
+    >>> session = Session(base_url, graph_store=GraphStore(ttl=600))
+    >>> case.traverse(depth=2, session=session)
+    >>> case.descendants(facts=[File])  # answered locally
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # {incoming: {fact: OrderedDict({reference: None})}}, the references
+        # of a fact are indexed by source (outgoing) and target (incoming)
+        self._index = {False: {}, True: {}}
+        # {(fact, incoming, reference class, reference type): expiry}
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _ends(reference, incoming):
+        """Return the (near, far) facts of a reference seen from the fact
+        whose references are indexed"""
+        if incoming:
+            return reference.target, reference.source
+        return reference.source, reference.target
+
+    @staticmethod
+    def _matches(reference, ref):
+        return reference._class == ref._class and \
+            (ref._type is None or reference._type == ref._type)
+
+    def get(self, fact, ref, incoming=False):
+        """Return the references of fact of the reference class ref if they
+        were loaded completely and are fresh, None otherwise"""
+        now = monotonic()
+        with self._lock:
+            for type in set([None, ref._type]):
+                expiry = self._loaded.get((fact, incoming, ref._class, type))
+                if expiry is not None and expiry > now:
+                    break
+            else:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            entries = self._index[incoming].get(fact, ())
+            return [r for r in entries if self._matches(r, ref)]
+
+    def put(self, fact, ref, incoming, references):
+        """Store the complete list of references of fact of the reference
+        class ref, replacing those stored before"""
+        with self._lock:
+            entries = self._index[incoming].setdefault(fact, OrderedDict())
+            for reference in list(entries):
+                if self._matches(reference, ref):
+                    self._remove(reference)
+
+            for reference in references:
+                self._add(reference)
+
+            self._loaded[(fact, incoming, ref._class, ref._type)] = \
+                monotonic() + self.ttl
+
+    def _add(self, reference):
+        for incoming in (False, True):
+            near, _ = self._ends(reference, incoming)
+            self._index[incoming].setdefault(near, OrderedDict())[
+                reference] = None
+
+    def _remove(self, reference):
+        for incoming in (False, True):
+            near, _ = self._ends(reference, incoming)
+            self._index[incoming].get(near, {}).pop(reference, None)
+
+    def invalidate(self, fact=None):
+        """Forget the references of fact and of its neighbours, or all
+        references if no fact is given"""
+        with self._lock:
+            if fact is None:
+                self._index = {False: {}, True: {}}
+                self._loaded.clear()
+                return
+
+            stale = set([fact])
+            for incoming in (False, True):
+                for reference in self._index[incoming].pop(fact, ()):
+                    _, far = self._ends(reference, incoming)
+                    stale.add(far)
+                    self._index[not incoming].get(far, {}).pop(
+                        reference, None)
+
+            for key in list(self._loaded):
+                if key[0] in stale:
+                    del self._loaded[key]
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._index[False].values())
@@ -0,0 +1,42 @@
+import hashlib
+
+# digests computed for uploaded and downloaded files
+HASHES = ('md5', 'sha1', 'sha256')
+
+
+class HashingReader(object):
+    """This class iterates over the content of a file-like object in chunks
+    of chunk_size bytes and hashes the content as it is read, so that a file
+    can be streamed and hashed in a single pass.
+
+    >>> reader = HashingReader(open('sample.bin', 'rb'))
+    >>> session.http_post(FILE_UPLOAD, data=reader)
+    >>> reader.hexdigests()['sha256']
+    """
+
+    def __init__(self, file_obj, chunk_size=1 << 20, hashes=HASHES):
+        self.file_obj = file_obj
+        self.chunk_size = chunk_size
+        self.size = 0
+        self._hashes = [(name, hashlib.new(name)) for name in hashes]
+
+    def update(self, chunk):
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+
+        for _, h in self._hashes:
+            h.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.file_obj.read(self.chunk_size)
+            if not chunk:
+                return
+            yield self.update(chunk)
+
+    def hexdigests(self):
+        """Return a mapping of {hash name: hex digest} of the content read
+        so far"""
+        return dict((name, h.hexdigest()) for name, h in self._hashes)
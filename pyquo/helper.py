@@ -1,11 +1,17 @@
 import logging
+import threading
 
 from .errors import SessionError
+from .identity import IdentityMap
 
 logger = logging.getLogger(__name__)
 
 class_registry = {}
 
+# classes generated for types without model, keyed by (type, base class)
+phantom_registry = {}
+_phantom_lock = threading.Lock()
+
 SYSREF_CLASS = "sysref"
 SYSFACT_CLASS = "sysfact"
 FACT_CLASS = "fact"
@@ -70,7 +76,18 @@ def ClassFactory(name, argnames, baseClass):
 
 
 class TypeFactory():
-    """This class generates pyquo model objects from json"""
+    """This class generates pyquo model objects from json.
+
+    lazy_documents and trusted are the global defaults of the
+    deserialization options of the same name, which can be overridden per
+    session. If lazy_documents is enabled, the fields of deserialized objects
+    are only assigned from the document when a field is accessed for the
+    first time. If trusted is enabled, documents received from the server
+    are assigned without running the field validators.
+    """
+    lazy_documents = False
+    trusted = False
+
     class_argnames = {
         REFERENCE_CLASS: ('target', 'source', 'document', 'session'),
         SYSREF_CLASS: ('target', 'source', 'document', 'session'),
@@ -82,13 +99,24 @@ class TypeFactory():
     @classmethod
     def _type_class(cls, type, argnames, baseClass):
         klass = class_registry.get(type)
-        if klass is None:
-            logger.warning('class %s not implemented', type)
-            return ClassFactory(
-                name=type,
-                argnames=argnames,
-                baseClass=baseClass
-            )
+        if klass is not None:
+            return klass
+
+        klass = phantom_registry.get((type, baseClass))
+        if klass is not None:
+            return klass
+
+        with _phantom_lock:
+            klass = phantom_registry.get((type, baseClass))
+            if klass is None:
+                if not any(t == type for t, _ in phantom_registry):
+                    logger.warning('class %s not implemented', type)
+
+                klass = phantom_registry[(type, baseClass)] = ClassFactory(
+                    name=type,
+                    argnames=argnames,
+                    baseClass=baseClass
+                )
 
         return klass
 
@@ -106,20 +134,59 @@ class TypeFactory():
             baseClass=baseClass
         )
 
+    @staticmethod
+    def _identity_map(session):
+        """Return the enabled identity map of the session or None"""
+        identity_map = getattr(session, 'identity_map', None)
+        if isinstance(identity_map, IdentityMap) and identity_map.enabled:
+            return identity_map
+
+    @classmethod
+    def _option(cls, session, name):
+        """Return the deserialization option of the session, falling back to
+        the global default if the session does not set it"""
+        value = getattr(session, name, None)
+        if isinstance(value, bool):
+            return value
+        return getattr(cls, name)
+
     @classmethod
-    def create_fact(cls, serialized):
+    def _set_document(cls, obj, document, session):
+        obj._load_document(
+            document,
+            lazy=cls._option(session, 'lazy_documents'),
+            trusted=cls._option(session, 'trusted'))
+
+    @staticmethod
+    def _fact_identity(serialized):
+        return serialized['class'], serialized['type'], serialized['id']
+
+    @classmethod
+    def create_fact(cls, serialized, session=None):
         baseClass = serialized['class']
 
+        identity_map = cls._identity_map(session)
+        if identity_map is not None:
+            key = cls._fact_identity(serialized)
+            obj = identity_map.get(key)
+            if obj is not None:
+                if 'document' in serialized:
+                    cls._set_document(obj, serialized['document'], session)
+                return obj
+
         factType = cls._create_object(serialized['type'], baseClass)
-        obj = factType(id=serialized['id'])
+        obj = factType(id=serialized['id'], session=session)
 
         if 'document' in serialized:
-            obj.document = serialized['document']
+            cls._set_document(obj, serialized['document'], session)
+
+        if identity_map is not None:
+            identity_map.add(key, obj)
 
         return obj
 
     @classmethod
-    def create_reference(cls, serialized):
+    def create_reference(cls, serialized, session=None):
         baseClass = serialized['class']
         target = serialized['target']
         source = serialized['source']
@@ -130,14 +197,25 @@ class TypeFactory():
         if source.get('class') is None:
             source['class'] = FACT_CLASS
 
-        target = cls.create_fact(target)
-        source = cls.create_fact(source)
+        identity_map = cls._identity_map(session)
+        obj = None
+        if identity_map is not None:
+            key = (baseClass, serialized['type'],
+                   cls._fact_identity(source), cls._fact_identity(target))
+            obj = identity_map.get(key)
+
+        if obj is None:
+            target = cls.create_fact(target, session)
+            source = cls.create_fact(source, session)
+
+            refType = cls._create_object(serialized['type'], baseClass)
+            obj = refType(target=target, source=source, session=session)
 
-        refType = cls._create_object(serialized['type'], baseClass)
-        obj = refType(target=target, source=source)
+            if identity_map is not None:
+                identity_map.add(key, obj)
 
         if 'document' in serialized:
-            obj.document = serialized['document']
+            cls._set_document(obj, serialized['document'], session)
 
         if "index" in serialized:
             obj.index = serialized["index"]
@@ -145,33 +223,35 @@ class TypeFactory():
         return obj
 
     @classmethod
-    def create_annotation(cls, serialized):
+    def create_annotation(cls, serialized, session=None):
         baseClass = serialized['class']
 
         # XXX remove once this is implemented serverside
         serialized['fact']['class'] = FACT_CLASS
 
-        fact = cls.create_fact(serialized['fact'])
+        fact = cls.create_fact(serialized['fact'], session)
         annoType = cls._create_object(serialized['type'], baseClass)
-        obj = annoType(fact=fact, label=serialized['label'])
+        obj = annoType(fact=fact, label=serialized['label'], session=session)
 
         if 'document' in serialized:
-            obj.document = serialized['document']
+            cls._set_document(obj, serialized['document'], session)
 
         return obj
 
     @classmethod
-    def deserialize(cls, serialized):
-        """This method deserializes a dictionary and returns a pyquo object"""
+    def deserialize(cls, serialized, session=None):
+        """This method deserializes a dictionary and returns a pyquo object.
+        If the session has an identity map, facts and references which are
+        already known are returned instead of new instances"""
         baseClass = serialized.get('class', 'fact')
 
         if baseClass in (SYSREF_CLASS, REFERENCE_CLASS):
-            return cls.create_reference(serialized)
+            return cls.create_reference(serialized, session)
 
         if baseClass in (SYSFACT_CLASS, FACT_CLASS):
-            return cls.create_fact(serialized)
+            return cls.create_fact(serialized, session)
 
         if baseClass == ANNOTATION_CLASS:
-            return cls.create_annotation(serialized)
+            return cls.create_annotation(serialized, session)
 
         raise Exception('unknown base class %s', baseClass)
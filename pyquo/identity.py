@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+
+class IdentityMap(object):
+    """This class maps the identity of facts and references, e.g.
+    ('fact', 'file', '<sha256>'), to the single live model instance of that
+    identity. The map holds at most maxsize instances, the least recently
+    used instances are evicted first. A maxsize of 0 disables the map.
+
+    >>> session = Session(base_url, identity_map_size=10000)
+    >>> session.identity_map.hits, session.identity_map.misses
+    >>> session.identity_map.clear()
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._objects = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.maxsize)
+
+    def get(self, key):
+        """Return the instance of the given identity or None"""
+        if not self.maxsize:
+            return None
+
+        with self._lock:
+            obj = self._objects.get(key)
+            if obj is None:
+                self.misses += 1
+                return None
+
+            # OrderedDict.move_to_end is missing on python2
+            self._objects[key] = self._objects.pop(key)
+            self.hits += 1
+            return obj
+
+    def add(self, key, obj):
+        """Store the instance of the given identity"""
+        if not self.maxsize:
+            return obj
+
+        with self._lock:
+            self._objects.pop(key, None)
+            self._objects[key] = obj
+
+            while len(self._objects) > self.maxsize:
+                self._objects.popitem(last=False)
+
+        return obj
+
+    def clear(self):
+        """Drop all instances, the hit and miss counters are kept"""
+        with self._lock:
+            self._objects.clear()
+
+    def __contains__(self, key):
+        return key in self._objects
+
+    def __len__(self):
+        return len(self._objects)
@@ -1,16 +1,114 @@
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import six
+
 from .base import Model
 from .helper import TypeFactory
+from .stream import iter_response_records
 
 MAGIC_PARSER_URL = "/v1/scan/text"
 
+# maximum number of characters scanned per request in batch mode and the
+# number of characters consecutive chunks share
+SCAN_CHUNK_SIZE = 256 * 1024
+SCAN_OVERLAP = 1024
+
+_LAST_SPACE = re.compile(r'\s\S*\Z')
+_SPACE = re.compile(r'\s')
+
+
+def split_text(text, chunk_size=SCAN_CHUNK_SIZE, overlap=SCAN_OVERLAP):
+    """Split text into chunks of at most chunk_size characters. Chunks end at
+    whitespace and consecutive chunks overlap by up to overlap characters,
+    starting at whitespace as well, so that no token is cut in half. Tokens
+    longer than chunk_size - 2 * overlap characters are cut."""
+    if chunk_size <= 2 * overlap:
+        raise ValueError('chunk_size must be larger than twice the overlap')
+
+    start = 0
+    while start + chunk_size < len(text):
+        end = start + chunk_size
+        space = _LAST_SPACE.search(text, start + overlap + 1, end)
+        if space is None:
+            yield text[start:end]
+            start = end - overlap
+            continue
+
+        end = space.start()
+        yield text[start:end]
+        # the first whitespace within the overlap, at the latest end itself
+        start = _SPACE.search(text, end - overlap, end + 1).start()
+
+    yield text[start:]
+
+
+def _imap(pool, func, iterable, window):
+    """Ordered pool.map submitting at most window calls ahead of the
+    results consumed"""
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
 
 class MagicParser(object):
     @classmethod
-    def parse(cls, text, session=None):
+    def parse(cls, text, session=None, stream=False):
         session = session or Model._session
 
         payload = {'text': text}
-        res = session.http_post(MAGIC_PARSER_URL, json=payload).json()
+        if stream:
+            res = session.http_post(MAGIC_PARSER_URL, json=payload,
+                                    stream=True)
+            records = iter_response_records(res)
+        else:
+            res = session.http_post(MAGIC_PARSER_URL, json=payload)
+            records = session.decode(res)['records']
+
+        for i in records:
+            yield TypeFactory.deserialize(i, session)
+
+    @classmethod
+    def parse_many(cls, texts, session=None, workers=4,
+                   chunk_size=SCAN_CHUNK_SIZE, overlap=SCAN_OVERLAP):
+        """This method scans large texts or many texts at once. Each text is
+        split into chunks, see split_text, which are scanned concurrently by
+        workers threads. The objects found are yielded in the order of the
+        chunks as soon as they are available, objects found in several
+        chunks or texts are yielded once.
+
+        :param texts: a text or an iterable of texts
+        """
+        session = session or Model._session
+        if isinstance(texts, six.string_types):
+            texts = [texts]
+
+        chunks = (chunk for text in texts
+                  for chunk in split_text(text, chunk_size, overlap) if chunk)
+
+        def scan(chunk):
+            res = session.http_post(MAGIC_PARSER_URL, json={'text': chunk})
+            return session.decode(res)['records']
+
+        seen = set()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for records in _imap(pool, scan, chunks, 2 * workers):
+                for record in records:
+                    key = cls._identity(record, session)
+                    if key in seen:
+                        continue
+
+                    seen.add(key)
+                    yield TypeFactory.deserialize(record, session)
 
-        for i in res['records']:
-            yield TypeFactory.deserialize(i)
+    @staticmethod
+    def _identity(record, session):
+        if 'id' in record:
+            return TypeFactory._fact_identity(record)
+        return session.codec.dumps(record)
@@ -1,11 +1,29 @@
+import io
 import os.path
-
-from .session import FILE_UPLOAD
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import six
+from requests.exceptions import ChunkedEncodingError, ConnectionError
+
+from .session import (
+    FILE_UPLOAD, FILE_DOWNLOAD, UPLOAD_CHUNK_SIZE, DOWNLOAD_CHUNK_SIZE,
+    SIMILAR_PAGE_SIZE
+)
+from .errors import ChecksumError, FetchError, ResultNotFound
+from .hashing import HashingReader
 from .helper import _resolve_classes, sessionize
 from .fields import Dict, List, String, Float, Integer, Flavor
 from .base import Reference, SysRef, Fact, SysFact, Annotation
 
 
+# result of File.upload_many for each of the given paths or file objects
+UploadResult = namedtuple('UploadResult', ('source', 'file', 'error'))
+
+# match of Function.similar_many
+SimilarFunction = namedtuple('SimilarFunction', ('function', 'score'))
+
+
 # Facts
 class Certificate(Fact):
     _type = 'certificate'
@@ -40,6 +58,14 @@ class File(Fact):
     # tlsh = String()
     # magic = Dict()
 
+    _hashes = None
+
+    @property
+    def hashes(self):
+        """Mapping of the md5, sha1 and sha256 hex digests of the content,
+        computed while the file was uploaded, None otherwise"""
+        return self._hashes
+
     @staticmethod
     def _extract_filename(file_obj):
         name = getattr(file_obj, 'name', None)
@@ -48,24 +74,31 @@ class File(Fact):
 
     @classmethod
     @sessionize
-    def upload(cls, file_obj, filename=None, session=None):
-        """ This function uploads a file_obj to quolab
+    def upload(cls, file_obj, filename=None, session=None,
+               chunk_size=UPLOAD_CHUNK_SIZE, dedupe=False):
+        """ This function uploads a file_obj to quolab. File-like objects
+        are streamed in chunks of chunk_size bytes, the content is hashed
+        while it is sent, see File.hashes.
 
         :param file_obj: can be a file-like object such as BytesIO
              or a string
         :param str filename: Name of the file, if not provided it will be
         guessed based on file_obj.name
+        :param dedupe: if True the content is hashed first and only sent if
+            the file does not exist on the server yet. Requires file-like
+            objects to be seekable, others are uploaded right away
 
         :returns: An instance of pyquo.models.File
         """
-        try:
-            content = file_obj.read()
-        except AttributeError:
-            content = file_obj
+        f = None
+        hashes = cls._hash(file_obj, chunk_size) if dedupe else None
+        if hashes is not None:
+            f = cls(id=hashes['sha256'])
+            session.fetch([f], strict=False)
+            f._hashes = hashes
 
-        headers = {'Content-Type': 'application/octet-stream'}
-        data = session.http_post(FILE_UPLOAD, data=content, headers=headers)
-        f = cls(id=data.json()['records'][0]['id']).get(session)
+        if f is None or not f._fetched:
+            f = cls._upload(file_obj, chunk_size, session)
 
         if filename is None:
             filename = cls._extract_filename(file_obj)
@@ -75,11 +108,281 @@ class File(Fact):
 
         return f
 
+    @classmethod
+    def _upload(cls, file_obj, chunk_size, session):
+        f = cls._post(file_obj, chunk_size, session).get(session)
+        return f
+
+    @classmethod
+    def _post(cls, file_obj, chunk_size, session):
+        """Send the content of file_obj and return a handle of the file"""
+        reader = HashingReader(file_obj, chunk_size)
+        if hasattr(file_obj, 'read'):
+            content = iter(reader)
+        else:
+            content = reader.update(file_obj)
+
+        headers = {'Content-Type': 'application/octet-stream'}
+        data = session.http_post(FILE_UPLOAD, data=content, headers=headers)
+        f = cls(id=session.decode(data)['records'][0]['id'])
+        f._hashes = reader.hexdigests()
+        return f
+
+    @classmethod
+    @sessionize
+    def upload_many(cls, paths_or_fileobjs, workers=4, session=None,
+                    chunk_size=UPLOAD_CHUNK_SIZE, dedupe=False,
+                    progress=None):
+        """ This function uploads many files at once using a pool of
+        worker threads. The uploaded files are fetched using batched
+        queries and their KnownAs annotations are saved using a single bulk
+        import. A failing upload does not stop the others, its error is
+        reported in its result. So are failures of the batched fetch or
+        import, in which case the file is uploaded but its result carries
+        the error as well.
+
+        :param paths_or_fileobjs: iterable of paths and file-like objects
+        :param workers: maximum number of concurrent uploads
+        :param dedupe: see File.upload, the existence of all files is
+            checked using batched queries
+        :param progress: callable called as progress(done, total, result)
+            each time the upload of a file is done
+
+        :returns: list of UploadResult(source, file, error) in the order
+            of paths_or_fileobjs
+        """
+        sources = list(paths_or_fileobjs)
+        results = [None] * len(sources)
+        done = []
+
+        def report(index, f=None, error=None):
+            results[index] = UploadResult(sources[index], f, error)
+            done.append(index)
+            if progress is not None:
+                progress(len(done), len(sources), results[index])
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = list(range(len(sources)))
+            if dedupe:
+                pending = cls._upload_existing(
+                    pool, sources, pending, chunk_size, report, session)
+
+            futures = dict(
+                (pool.submit(cls._open, sources[index], cls._post,
+                             chunk_size, session), index)
+                for index in pending)
+            for future in as_completed(futures):
+                try:
+                    report(futures[future], f=future.result())
+                except Exception as e:
+                    report(futures[future], error=e)
+
+        # the files are on the server by now, errors of the batched requests
+        # are reported in the results of the files concerned
+        def fail(indices, error):
+            for index in indices:
+                if results[index].error is None:
+                    results[index] = results[index]._replace(error=error)
+
+        uploaded = [index for index, result in enumerate(results)
+                    if result.file is not None]
+        pending = [index for index in uploaded
+                   if not results[index].file._fetched]
+        try:
+            session.fetch([results[index].file for index in pending],
+                          strict=False)
+        except Exception as e:
+            fail(pending, e)
+        else:
+            for index in pending:
+                f = results[index].file
+                if not f._fetched:
+                    fail([index], ResultNotFound(
+                        'Uploaded file {} not found'.format(f)))
+
+        annotated = []
+        annotations = []
+        for index in uploaded:
+            filename = cls._source_filename(results[index].source)
+            if filename:
+                annotated.append(index)
+                annotations.append(KnownAs(results[index].file, filename))
+
+        if annotations:
+            try:
+                session.bulk_import(annotations)
+            except Exception as e:
+                fail(annotated, e)
+
+        return results
+
+    @classmethod
+    def _upload_existing(cls, pool, sources, pending, chunk_size, report,
+                         session):
+        """Hash the sources, fetch the files which exist already using
+        batched queries and report them. Returns the indices of the sources
+        left to upload"""
+        futures = dict(
+            (pool.submit(cls._open, sources[index], cls._hash, chunk_size),
+             index)
+            for index in pending)
+
+        hashed = []
+        for future in as_completed(futures):
+            try:
+                hashes = future.result()
+            except Exception as e:
+                report(futures[future], error=e)
+                continue
+
+            f = None
+            if hashes is not None:
+                f = cls(id=hashes['sha256'])
+                f._hashes = hashes
+            hashed.append((futures[future], f))
+
+        try:
+            session.fetch([f for _, f in hashed if f is not None],
+                          strict=False)
+        except Exception:
+            # the existence is unknown, upload the files anyway
+            pass
+
+        left = []
+        for index, f in sorted(hashed, key=lambda item: item[0]):
+            if f is not None and f._fetched:
+                report(index, f=f)
+            else:
+                left.append(index)
+        return left
+
+    @staticmethod
+    def _open(source, func, *args):
+        """Call func with the file-like object of source, which is either a
+        path or a file-like object"""
+        if isinstance(source, six.string_types):
+            with open(source, 'rb') as file_obj:
+                return func(file_obj, *args)
+
+        return func(source, *args)
+
+    @classmethod
+    def _source_filename(cls, source):
+        if isinstance(source, six.string_types):
+            return os.path.basename(source)
+        return cls._extract_filename(source)
+
+    @staticmethod
+    def _hash(file_obj, chunk_size):
+        """Return the digests of the content of file_obj and rewind it.
+        Returns None if file_obj cannot be rewound"""
+        reader = HashingReader(file_obj, chunk_size)
+        if not hasattr(file_obj, 'read'):
+            reader.update(file_obj)
+            return reader.hexdigests()
+
+        seekable = getattr(file_obj, 'seekable', None)
+        if seekable is None or not seekable():
+            return None
+
+        start = file_obj.tell()
+        for _ in reader:
+            pass
+        file_obj.seek(start)
+        return reader.hexdigests()
+
     @sessionize
     def download(self, session=None):
         url = '/v1/file/{}'.format(self.id)
         return session.http_get(url)
 
+    @sessionize
+    def download_to(self, path_or_fileobj, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                    retries=3, resume=False, session=None):
+        """ This function streams the content of the file to a path or a
+        writable binary file object in chunks of chunk_size bytes. If the
+        connection drops the download is resumed where it stopped using a
+        Range request, at most retries times. The content is verified
+        against the sha256 id of the file and its digests are available as
+        File.hashes.
+
+        :param resume: if True and path_or_fileobj is the path of a
+            partially downloaded file, the download continues at its end
+        :raises ChecksumError: if the content does not match the id
+        :returns: self
+        """
+        # nothing downloaded yet
+        hasher = HashingReader(io.BytesIO())
+        if hasattr(path_or_fileobj, 'write'):
+            return self._download(path_or_fileobj, hasher, chunk_size,
+                                  retries, session)
+
+        mode = 'wb'
+        if resume and os.path.exists(path_or_fileobj):
+            with open(path_or_fileobj, 'rb') as fp:
+                hasher = HashingReader(fp, chunk_size)
+                for _ in hasher:
+                    pass
+            mode = 'ab'
+
+        with open(path_or_fileobj, mode) as fp:
+            return self._download(fp, hasher, chunk_size, retries, session)
+
+    def _download(self, fp, hasher, chunk_size, retries, session):
+        url = FILE_DOWNLOAD.format(self.id)
+        attempt = 0
+        while not self._download_range(url, fp, hasher, chunk_size, session,
+                                       retry=attempt < retries):
+            attempt += 1
+
+        hashes = hasher.hexdigests()
+        if hashes['sha256'] != self.id.lower():
+            raise ChecksumError('sha256 {} of the content of {} does not '
+                                'match'.format(hashes['sha256'], self))
+
+        self._hashes = hashes
+        return self
+
+    @staticmethod
+    def _download_range(url, fp, hasher, chunk_size, session, retry):
+        """Write the content following the hasher.size bytes written so far
+        to fp. Returns False if the connection dropped and retry is True"""
+        offset = hasher.size
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+        try:
+            res = session.http_get(url, headers=headers, stream=True)
+        except ConnectionError:
+            if not retry:
+                raise
+            return False
+
+        try:
+            if offset and res.status_code == 416:
+                # the content was complete already
+                return True
+
+            if res.status_code not in (200, 206):
+                raise FetchError("unexpected http code <{}> {}".format(
+                    res.status_code, res.content), res.status_code)
+
+            # the server ignored the range, skip what was written already
+            skip = offset if res.status_code == 200 else 0
+            for chunk in res.iter_content(chunk_size):
+                if skip:
+                    skipped = min(skip, len(chunk))
+                    chunk, skip = chunk[skipped:], skip - skipped
+                if chunk:
+                    fp.write(hasher.update(chunk))
+        except (ChunkedEncodingError, ConnectionError):
+            if not retry:
+                raise
+            return False
+        finally:
+            res.close()
+
+        return True
+
 
 class Function(Fact):
     _type = 'function'
@@ -87,7 +390,7 @@ class Function(Fact):
     @sessionize
     def similar(self, session=None):
         path = '/v1/function/{}/similar'.format(self.id)
-        response = session.http_get(path).json()
+        response = session.decode(session.http_get(path))
         similars = response.get('records', [])
 
         return (
@@ -95,6 +398,67 @@ class Function(Fact):
             for match in similars
         )
 
+    @classmethod
+    @sessionize
+    def similar_many(cls, functions, workers=4, page_size=SIMILAR_PAGE_SIZE,
+                     fetch=True, session=None):
+        """ This function looks up the functions similar to each of the
+        given functions concurrently, paging through long similarity lists
+        page_size matches at a time. The documents of all matched functions
+        are fetched using batched queries.
+
+        :param functions: iterable of Function instances
+        :param workers: maximum number of concurrent lookups
+        :param fetch: if False the matched functions are returned as handles
+
+        :returns: list of lists of SimilarFunction(function, score) in the
+            order of functions, score is None if the server sends none
+        """
+        functions = list(functions)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pages = list(pool.map(
+                lambda function: cls._similar_records(
+                    function.id, page_size, session),
+                functions))
+
+        results = [
+            [SimilarFunction(cls(id=match['id'], session=session),
+                             match.get('score'))
+             for match in records]
+            for records in pages
+        ]
+
+        if fetch:
+            session.fetch([match.function for matches in results
+                           for match in matches], strict=False)
+
+        return results
+
+    @staticmethod
+    def _similar_records(id, page_size, session):
+        path = '/v1/function/{}/similar'.format(id)
+        records = []
+        seen = set()
+        offset = 0
+        previous = None
+
+        while True:
+            res = session.http_get('{}?limit={}&offset={}'.format(
+                path, page_size, offset))
+            page = session.decode(res).get('records', [])
+            offset += len(page)
+
+            for match in page:
+                if match['id'] not in seen:
+                    seen.add(match['id'])
+                    records.append(match)
+
+            # a server ignoring the offset sends the same page again
+            ids = [match['id'] for match in page]
+            if len(page) < page_size or ids == previous:
+                return records
+            previous = ids
+
 
 class Hostname(Fact):
     _type = 'hostname'
@@ -0,0 +1,122 @@
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+try:
+    from time import monotonic
+except ImportError:
+    # python2
+    from time import time as monotonic
+
+
+class RateLimiter(object):
+    """This class limits the requests a session sends to the server. A token
+    bucket caps the request rate to rate requests per second with bursts of
+    up to burst requests. If concurrency is given, the number of requests in
+    flight is limited as well. That limit adapts to the server: it is halved
+    whenever the server throttles a request (429/503) or a request fails,
+    e.g. times out, and grows by one per window of successful requests, up
+    to concurrency.
+
+    >>> limiter = RateLimiter(rate=50, concurrency=16)
+    >>> session = Session(base_url, rate_limiter=limiter, retries=5)
+
+    A limiter can be shared by several sessions talking to the same server.
+    """
+
+    def __init__(self, rate=None, burst=None, concurrency=None,
+                 min_concurrency=1):
+        self.rate = rate
+        self.burst = burst or max(1, rate or 0)
+        self.concurrency = concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(concurrency or 0)
+        self.active = 0
+        self.throttled = 0
+
+        self._tokens = float(self.burst)
+        self._updated = monotonic()
+        self._paused_until = 0
+        self._cond = threading.Condition()
+
+    def _wait_time(self, now):
+        """Return the time to wait for the next token, take it if there
+        is one"""
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        if self.rate is None:
+            return 0
+
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        with self._cond:
+            while True:
+                # wait for a slot before taking a token, waking up must not
+                # use up tokens
+                if self.concurrency and self.active >= int(self.limit):
+                    self._cond.wait()
+                    continue
+
+                wait = self._wait_time(monotonic())
+                if wait:
+                    # sleep without holding the lock
+                    self._cond.release()
+                    try:
+                        time.sleep(wait)
+                    finally:
+                        self._cond.acquire()
+                    continue
+
+                self.active += 1
+                return
+
+    def release(self, throttled=False, delay=None):
+        """Report the end of a request. If the server throttled it the
+        concurrency limit is decreased and, if delay is given, no request is
+        sent for delay seconds"""
+        with self._cond:
+            self.active -= 1
+
+            if throttled:
+                self.throttled += 1
+                if self.concurrency:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                if delay:
+                    self._paused_until = max(self._paused_until,
+                                             monotonic() + delay)
+            elif self.concurrency:
+                self.limit = min(self.concurrency,
+                                 self.limit + 1 / self.limit)
+
+            self._cond.notify_all()
+
+
+def retry_after(res):
+    """Return the delay in seconds requested by the Retry-After header of a
+    response, or None"""
+    value = res.headers.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0.0, mktime_tz(date) - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
@@ -1,13 +1,25 @@
 from requests import Session
+from requests.adapters import HTTPAdapter
 import json
+import random
+import time
 
 try:
     from urllib.parse import urljoin
 except ImportError:
     from urlparse import urljoin
 
-from .errors import FetchError
+from collections import OrderedDict
+
+from .codec import JSONCodec, get_codec
+from .compression import (
+    COMPRESS_THRESHOLD, ENCODINGS, TransferStats, compress
+)
+from .errors import FetchError, ResultNotFound
 from .helper import TypeFactory
+from .identity import IdentityMap
+from .ratelimit import retry_after
+from .stream import iter_response_records
 
 import logging
 
@@ -21,6 +33,16 @@ AUTH_LOGIN = "/v1/auth/login"
 FILE_UPLOAD = '/v1/file'
 FILE_DOWNLOAD = FILE_UPLOAD + '/{}'
 
+IMPORT_CHUNK_SIZE = 500
+FETCH_CHUNK_SIZE = 500
+UPLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+SIMILAR_PAGE_SIZE = 500
+
+# status codes of throttled requests which are worth retrying
+RETRY_STATUS = (429, 503)
+BACKOFF_MAX = 60
+
 
 def expect(*codes):
     def wrap(func, *args, **kwargs):
@@ -39,8 +61,14 @@ def logme(func):
         name = func.__code__.co_name.upper()
         logger.debug('%s %s data: %s', name.upper(), path, kwargs)
         res = func(self, path, *args, **kwargs)
+        if not logger.isEnabledFor(logging.DEBUG):
+            return res
+        if kwargs.get('stream'):
+            # reading the body would defeat streaming
+            logger.debug('%d: Streamed response', res.status_code)
+            return res
         try:
-            resp = res.json()
+            resp = self.decode(res)
         except Exception:
             resp = res.content
         logger.debug('%d: Response %s', res.status_code, resp)
@@ -62,78 +90,341 @@ class Session(Session):
         >>> s = Session("http://qlab01-dev.app.quo:9090/v1/", None)
         >>> s.get(Case, "2ee9b31253f44e6cb1d40ff7af333b4f")
 
+        Request and response bodies are encoded using the given codec, which
+        can be a codec name (e.g. 'orjson') or a pyquo.codec.JSONCodec
+        instance. By default the fastest installed json library is used.
+
+        If identity_map_size is non-zero, deserialized facts and references
+        are kept in session.identity_map so that there is a single instance
+        per fact or reference, see pyquo.identity.IdentityMap.
+
+        If lazy_documents is True the documents of deserialized objects are
+        only assigned to their fields once a field is accessed. If trusted is
+        True the documents received from the server are not validated, values
+        assigned by the user still are. If None the global defaults
+        TypeFactory.lazy_documents and TypeFactory.trusted apply.
+
+        A session can be shared by many threads, the http_* methods are safe
+        to call concurrently. Each thread checks a connection out of the pool
+        of the server's host for the duration of a request, pool_maxsize
+        should therefore be at least the number of worker threads. The
+        headers, auth and adapters of the session must not be changed while
+        requests are in flight.
+
+        :param pool_connections: number of hosts to keep connection pools for
+        :param pool_maxsize: maximum number of connections kept per host
+        :param pool_block: if True a request waits for a free connection
+            instead of opening one that is discarded afterwards
+        :param keep_alive: if False connections are closed after each request
+        :param timeout: timeout of every request in seconds, either a float
+            or a (connect, read) tuple. None waits forever
+        :param rate_limiter: pyquo.ratelimit.RateLimiter applied to every
+            request
+        :param retries: number of times idempotent requests (queries and
+            GET requests) are retried if the server throttles them
+        :param backoff: base delay in seconds of the jittered exponential
+            backoff between retries, a Retry-After header takes precedence
+        :param graph_store: pyquo.graph.GraphStore answering reference
+            queries locally
+        :param compress: content encoding ('gzip' or 'deflate') used to
+            compress POST and PATCH bodies of at least compress_threshold
+            bytes. The server must accept compressed requests
+
+        Compressed responses are accepted (Accept-Encoding) and decompressed
+        transparently, including streamed ones. The bytes sent and received
+        are counted in session.stats, see pyquo.compression.TransferStats.
     """
     def __init__(self, base_url, verify=True, auth=None, global_session=False,
+                 codec=None, identity_map_size=0, lazy_documents=None,
+                 trusted=None, pool_connections=10, pool_maxsize=10,
+                 pool_block=False, keep_alive=True, timeout=None,
+                 rate_limiter=None, retries=0, backoff=0.5, compress=None,
+                 compress_threshold=COMPRESS_THRESHOLD, graph_store=None,
                  *args, **kwargs):
         super(Session, self).__init__(*args, **kwargs)
         self.url = base_url
         self.verify = verify
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        self.backoff = backoff
+        if compress is not None and compress not in ENCODINGS:
+            raise ValueError('unknown content encoding {}'.format(compress))
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self.stats = TransferStats()
+        self.graph_store = graph_store
+
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=pool_block)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        if not keep_alive:
+            self.headers['Connection'] = 'close'
+
+        if not isinstance(codec, JSONCodec):
+            codec = get_codec(codec)
+        self.codec = codec
+        self.identity_map = IdentityMap(identity_map_size)
+        self.lazy_documents = lazy_documents
+        self.trusted = trusted
         if global_session is True:
             set_global_session(self)
 
         if auth:
             auth(self)
 
-    @logme
-    def http_post(self, path, data=None, json=None, headers={}):
+    def encode(self, data, json, headers):
+        """Encode a json body using the session codec"""
+        if json is None:
+            return data, headers
+
+        headers = dict(headers)
+        headers.setdefault('Content-Type', 'application/json')
+        return self.codec.dumps(json), headers
+
+    def decode(self, res):
+        """Decode a json response using the session codec"""
+        return self.codec.loads(res.content)
+
+    def _request(self, method, path, data=None, json=None, headers={},
+                 stream=False):
+        """Perform a request against the server, all http_* methods go
+        through this method"""
         url = urljoin(self.url, path)
-        res = self.post(url, data=data, json=json,
-                        headers=headers, verify=self.verify)
+        data, headers = self.encode(data, json, headers)
+        size = len(data) if isinstance(data, bytes) else 0
+        if method in ('POST', 'PATCH'):
+            data, headers = self._compress(data, headers)
+
+        res = self._send(method, url, data, headers, stream)
+        self.stats.add_request(
+            len(data) if isinstance(data, bytes) else 0, size)
+        if not stream:
+            self.stats.add_response(res)
+        return res
+
+    def _compress(self, data, headers):
+        """Compress a request body if compression is enabled and the body
+        is at least compress_threshold bytes large"""
+        if (not self.compress or not isinstance(data, bytes) or
+                len(data) < self.compress_threshold or
+                'Content-Encoding' in headers):
+            return data, headers
+
+        headers = dict(headers)
+        headers['Content-Encoding'] = self.compress
+        return compress(data, self.compress), headers
+
+    def _send(self, method, url, data, headers, stream):
+        limiter = self.rate_limiter
+        if limiter is None:
+            return self.request(method, url, data=data, headers=headers,
+                                verify=self.verify, stream=stream,
+                                timeout=self.timeout)
+
+        limiter.acquire()
+        try:
+            res = self.request(method, url, data=data, headers=headers,
+                               verify=self.verify, stream=stream,
+                               timeout=self.timeout)
+        except BaseException:
+            # timeouts and dropped connections hint at an overloaded server
+            limiter.release(throttled=True)
+            raise
+
+        throttled = res.status_code in RETRY_STATUS
+        limiter.release(throttled, throttled and retry_after(res))
         return res
 
+    def _retry(self, send):
+        """Call send, which performs an idempotent request, until the
+        response is not throttled or the retries are exhausted"""
+        attempt = 0
+        while True:
+            res = send()
+            if res.status_code not in RETRY_STATUS or attempt >= self.retries:
+                return res
+
+            delay = retry_after(res)
+            if delay is None:
+                delay = random.uniform(
+                    0, min(BACKOFF_MAX, self.backoff * 2 ** attempt))
+
+            logger.info('%d: Request throttled, retrying in %.2fs',
+                        res.status_code, delay)
+            res.close()
+            time.sleep(delay)
+            attempt += 1
+
+    @logme
+    def http_post(self, path, data=None, json=None, headers={},
+                  stream=False):
+        return self._request('POST', path, data=data, json=json,
+                             headers=headers, stream=stream)
+
     @logme
     def http_patch(self, path, data=None, json=None, headers={}):
-        url = urljoin(self.url, path)
-        res = self.patch(url, data=data, json=json,
-                         headers=headers, verify=self.verify)
-        return res
+        return self._request('PATCH', path, data=data, json=json,
+                             headers=headers)
 
     @logme
     def http_delete(self, path, data=None, json=None, headers={}):
-        url = urljoin(self.url, path)
-        res = self.delete(url, data=data, json=json,
-                          headers=headers, verify=self.erify)
-        return res
+        return self._request('DELETE', path, data=data, json=json,
+                             headers=headers)
 
     @logme
-    def http_get(self, path):
-        url = urljoin(self.url, path)
-        res = self.get(url, verify=self.verify)
-        return res
+    def http_get(self, path, headers={}, stream=False):
+        return self._retry(lambda: self._request(
+            'GET', path, headers=headers, stream=stream))
 
     def remove(self, query):
         @expect(200)
         def q(self, query):
             return self.http_delete(CATALOG_QUERY, json=query)
-        return q(self, query).json()
+        return self.decode(q(self, query))
 
-    def _query(self, query):
+    def _query(self, query, stream=False):
+        """This method executes a catalog query and returns its records. If
+        stream is True the response is parsed incrementally and the records
+        are yielded as they arrive"""
         @expect(200)
         def q(self, query):
             if isinstance(query, str):
                 query = json.dumps(query)
 
-            return self.http_post(CATALOG_QUERY, json=query)
-        return q(self, query).json()['records']
+            return self._retry(lambda: self.http_post(
+                CATALOG_QUERY, json=query, stream=stream))
+
+        if stream:
+            return self._stream_query(q, query)
+
+        return self.decode(q(self, query))['records']
+
+    def _stream_query(self, q, query):
+        for record in iter_response_records(q(self, query)):
+            yield record
 
     def _import(self, query):
         @expect(200)
         def q(self, query):
             return self.http_post(CATALOG_IMPORT, json=query)
-        return q(self, query).json()
+        return self.decode(q(self, query))
+
+    def bulk_import(self, objects, chunk_size=None):
+        """This method imports many model objects at once. The objects are
+        grouped by their class and sent in chunks of chunk_size records per
+        import request. The required fields of every object are checked
+        before anything is sent.
+
+        :returns: list of deserialized objects in the order of objects
+        """
+        chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+        objects = list(objects)
+
+        groups = OrderedDict()
+        for index, obj in enumerate(objects):
+            record = obj._import_record()
+            groups.setdefault(obj._class, []).append((index, record))
+
+        results = [None] * len(objects)
+        for cl, records in groups.items():
+            for offset in range(0, len(records), chunk_size):
+                chunk = records[offset:offset + chunk_size]
+                res = self._import({cl: [record for _, record in chunk]})
+                res = res.get(cl) or []
+
+                if len(res) != len(chunk):
+                    raise FetchError(
+                        "import returned {} {} records, expected {}".format(
+                            len(res), cl, len(chunk)))
+
+                for (index, _), item in zip(chunk, res):
+                    item.setdefault('class', cl)
+                    results[index] = TypeFactory.deserialize(item, self)
+
+        for obj in objects:
+            obj._invalidate(self)
+
+        return results
+
+    def fetch(self, objects, chunk_size=None, strict=True):
+        """This method fetches the documents of many facts at once. The facts
+        are grouped by class and type and each group is queried using id
+        lists of up to chunk_size ids. The document of each given object is
+        set in place.
+
+        :param strict: if True a ResultNotFound is raised if any of the facts
+            does not exist
+        :returns: list of the given objects
+        """
+        objects = list(objects)
+        batches = fetch_batches(objects, chunk_size)
+        results = [self._query(query) for _, query in batches]
+        load_fetched(self, batches, results, strict)
+
+        return objects
 
     def _patch(self, query):
         @expect(200)
         def q(self, query):
             return self.http_patch(CATALOG_QUERY, json=query)
-        return q(self, query).json()
+        return self.decode(q(self, query))
 
     @property
     def current_user(self):
         @expect(200)
         def q(self):
             return self.http_get(AUTH_LOGIN)
-        return q(self).json()['user']['id']
+        return self.decode(q(self))['user']['id']
+
+
+def fetch_batches(objects, chunk_size=None):
+    """Group objects by class, type and id and return the (handles, query)
+    batches fetching them, see Session.fetch. handles maps the ids of a
+    query to the objects of that id"""
+    chunk_size = chunk_size or FETCH_CHUNK_SIZE
+
+    groups = OrderedDict()
+    for obj in objects:
+        handles = groups.setdefault((obj._class, obj._type), OrderedDict())
+        handles.setdefault(obj.id, []).append(obj)
+
+    batches = []
+    for (cl, type), handles in groups.items():
+        ids = list(handles)
+        for offset in range(0, len(ids), chunk_size):
+            chunk = ids[offset:offset + chunk_size]
+            query = {
+                'class': cl,
+                'type': type,
+                'id': chunk,
+                'limit': len(chunk)
+            }
+            batches.append((
+                OrderedDict((id, handles[id]) for id in chunk), query))
+
+    return batches
+
+
+def load_fetched(session, batches, results, strict=True):
+    """Load the records fetched by the queries of batches into the objects,
+    results holds the records of each query"""
+    trusted = TypeFactory._option(session, 'trusted')
+
+    missing = []
+    for (handles, _), records in zip(batches, results):
+        for record in records:
+            for obj in handles.pop(record['id'], ()):
+                obj._load_document(record.get('document', {}),
+                                   trusted=trusted)
+                obj._fetched = True
+
+        missing.extend(obj for objs in handles.values() for obj in objs)
+
+    if strict and missing:
+        raise ResultNotFound('Result not found for {}'.format(missing))
 
 
 class Filter():
@@ -142,7 +433,29 @@ class Filter():
         self._class = parent._class
 
     def __call__(self, target=None, source=None, fact=None,
-                 document=None, session=None, **kwargs):
+                 document=None, session=None, stream=False, **kwargs):
+        results = self.query(
+            session=session,
+            _type=self._type,
+            _class=self._class,
+            document=document,
+            stream=stream,
+            **self._relations(target, source, fact, kwargs)
+        )
+
+        if stream:
+            return (TypeFactory.deserialize(r, session) for r in results)
+
+        return [TypeFactory.deserialize(r, session) for r in results]
+
+    def acall(self, target=None, source=None, fact=None,
+              document=None, session=None, **kwargs):
+        """Awaitable variant of __call__, requires an AsyncSession"""
+        from .aio import afilter
+        return afilter(self, session, target, source, fact, document, kwargs)
+
+    @staticmethod
+    def _relations(target, source, fact, kwargs):
         if target:
             kwargs['target'] = target.serialize
         if source:
@@ -150,17 +463,15 @@ class Filter():
         if fact:
             kwargs['fact'] = [f.serialize for f in fact]
 
-        results = self.query(
-            session=session,
-            _type=self._type,
-            _class=self._class,
-            document=document,
-            **kwargs
-        )
+        return kwargs
 
-        return [TypeFactory.deserialize(r) for r in results]
+    def query(self, session, _type, _class, document=None, stream=False,
+              **kwargs):
+        query = self._build(_type, _class, document, **kwargs)
+        return session._query(query, stream=stream)
 
-    def query(self, session, _type, _class, document=None, **kwargs):
+    @staticmethod
+    def _build(_type, _class, document=None, **kwargs):
         query = dict(kwargs)
         query.update({
             'type': _type,
@@ -170,18 +481,19 @@ class Filter():
         if isinstance(document, dict):
             query['document'] = document
 
-        return session._query(query)
+        return query
 
 
 class Query():
     """This class allows issuing raw queries to the API"""
     @classmethod
-    def generate(cls, query, session):
-        """This method returns serialized pyquo objects"""
-        for i in cls.execute(query, session):
-            yield TypeFactory.deserialize(i)
+    def generate(cls, query, session, stream=False):
+        """This method returns serialized pyquo objects. If stream is True
+        the objects are yielded while the response is being received"""
+        for i in cls.execute(query, session, stream=stream):
+            yield TypeFactory.deserialize(i, session)
 
     @classmethod
-    def execute(cls, query, session):
+    def execute(cls, query, session, stream=False):
         """This method returns the raw query request"""
-        return session._query(query)
+        return session._query(query, stream=stream)
@@ -0,0 +1,165 @@
+import codecs
+import json
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+_DELIMITERS = _WHITESPACE + ',]}'
+_decoder = json.JSONDecoder()
+_INCOMPLETE = object()
+
+# parser states
+_OBJECT, _KEY, _COLON, _VALUE, _NEXT_KEY, \
+    _ARRAY, _ELEMENT, _NEXT_ELEMENT, _DONE = range(9)
+
+
+class RecordParser(object):
+    """Incremental parser for json objects of the form {"records": [...]}.
+    Text is fed in arbitrary pieces and the elements of the records array are
+    returned as soon as they are complete, so that only the element which is
+    currently being received is held in memory"""
+
+    def __init__(self, key='records'):
+        self._key = key
+        self._buffer = ''
+        self._pos = 0
+        self._state = _OBJECT
+        self._current = None
+        self._found = False
+
+    def feed(self, text, final=False):
+        """Feed a piece of text to the parser and return the list of array
+        elements which have been completed by it"""
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        records = []
+
+        while self._state != _DONE:
+            self._skip_whitespace()
+            if self._pos >= len(self._buffer):
+                break
+
+            char = self._buffer[self._pos]
+
+            if self._state == _OBJECT:
+                self._expect(char, '{')
+                self._state = _KEY
+
+            elif self._state in (_KEY, _NEXT_KEY):
+                if char == '}':
+                    self._pos += 1
+                    self._state = _DONE
+                elif self._state == _NEXT_KEY:
+                    self._expect(char, ',')
+                    self._state = _KEY
+                else:
+                    key = self._decode(final)
+                    if key is _INCOMPLETE:
+                        break
+                    self._current = key
+                    self._state = _COLON
+
+            elif self._state == _COLON:
+                self._expect(char, ':')
+                if self._current == self._key:
+                    self._found = True
+                    self._state = _ARRAY
+                else:
+                    self._state = _VALUE
+
+            elif self._state == _VALUE:
+                if self._decode(final) is _INCOMPLETE:
+                    break
+                self._state = _NEXT_KEY
+
+            elif self._state == _ARRAY:
+                self._expect(char, '[')
+                self._state = _ELEMENT
+
+            elif self._state in (_ELEMENT, _NEXT_ELEMENT):
+                if char == ']':
+                    self._pos += 1
+                    self._state = _NEXT_KEY
+                elif self._state == _NEXT_ELEMENT:
+                    self._expect(char, ',')
+                    self._state = _ELEMENT
+                else:
+                    record = self._decode(final)
+                    if record is _INCOMPLETE:
+                        break
+                    records.append(record)
+                    self._state = _NEXT_ELEMENT
+
+        if final:
+            if self._state != _DONE:
+                raise ValueError('truncated json document')
+            if not self._found:
+                raise KeyError(self._key)
+
+        return records
+
+    def _skip_whitespace(self):
+        buffer, pos = self._buffer, self._pos
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+            pos += 1
+        self._pos = pos
+
+    def _expect(self, char, expected):
+        if char != expected:
+            raise ValueError('expected "{}" at "{}"'.format(
+                expected, self._buffer[self._pos:self._pos + 20]))
+        self._pos += 1
+
+    def _decode(self, final):
+        """Decode the value at the current position. The value is only
+        accepted if more data follows it and, for numbers, if that data is a
+        delimiter, since e.g. a number at the end of the buffer might be
+        incomplete. Returns _INCOMPLETE and leaves the
+        position untouched if more data is needed"""
+        try:
+            value, end = _decoder.raw_decode(self._buffer, self._pos)
+        except ValueError:
+            if final:
+                raise
+            return _INCOMPLETE
+
+        if final:
+            self._pos = end
+            return value
+
+        if end >= len(self._buffer):
+            return _INCOMPLETE
+
+        # raw_decode stops a number at e.g. the "." of "1." or the "e" of
+        # "1e", the number is only complete if a delimiter follows it
+        if isinstance(value, (int, float)) and not isinstance(value, bool) \
+                and self._buffer[end] not in _DELIMITERS:
+            return _INCOMPLETE
+
+        self._pos = end
+        return value
+
+
+def iter_records(chunks, key='records', encoding='utf-8'):
+    """Yield the elements of the key array of a json object which is
+    received as an iterable of byte chunks"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    parser = RecordParser(key)
+
+    for chunk in chunks:
+        for record in parser.feed(decoder.decode(chunk)):
+            yield record
+
+    for record in parser.feed(decoder.decode(b'', final=True), final=True):
+        yield record
+
+
+def iter_response_records(response, key='records',
+                          chunk_size=STREAM_CHUNK_SIZE):
+    """Yield the records of a streamed requests response and release the
+    connection once the response has been consumed"""
+    try:
+        for record in iter_records(response.iter_content(chunk_size), key):
+            yield record
+    finally:
+        response.close()
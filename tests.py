@@ -1,13 +1,41 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 try:
-    from unittest.mock import MagicMock
+    from unittest.mock import MagicMock, patch
 except ImportError:
-    from mock import MagicMock
+    from mock import MagicMock, patch
+from requests.exceptions import ChunkedEncodingError, Timeout
 from pyquo.session import Session, Query
-from pyquo.fields import Integer, String
-from pyquo.models import Fact, Reference, File, URL, Contains
-from pyquo.errors import ValidationError, RequiredError, SessionError
-from pyquo.helper import _register_class
+from pyquo.fields import Integer, String, Unset
+from pyquo.models import (
+    Fact, Reference, File, Function, Hostname, IpAddress, URL, Contains,
+    KnownAs
+)
+from pyquo.errors import (
+    ValidationError, RequiredError, SessionError, ResultNotFound, FetchError,
+    ChecksumError
+)
+from pyquo.helper import _register_class, TypeFactory, phantom_registry
+from pyquo.graph import GraphStore
+from pyquo.identity import IdentityMap
+from pyquo.aio import AsyncSession, aiohttp
+from pyquo.authenticator import TokenAuthenticator, UserAuthenticator
+from pyquo.codec import JSONCodec, CODECS, get_codec
+from pyquo.compression import ENCODINGS, compress
+from pyquo.magicparser import MagicParser, split_text
+from pyquo.ratelimit import RateLimiter, retry_after
+from pyquo.stream import iter_records
 from pyquo.fields import (
     StringValidator, FloatValidator, DictValidator,
     IntegerValidator, ListValidator, ChoiceValidator
@@ -79,6 +107,30 @@ class TestPyQuo(unittest.TestCase):
             TestFactModel(id="identifier", session=session).save(
                 session=session)
 
+    def testSchemalessDocumentKeys(self):
+        fields = dict(TestFactModel._fields)
+        document = {'name': 'foo', 'unknown-key': 1, 'extra': [1],
+                    'references': 2}
+        test = TestFactModel(id='123', document=document)
+
+        self.assertEqual(TestFactModel._fields, fields)
+        self.assertEqual(test.extra, [1])
+        self.assertEqual(getattr(test, 'unknown-key'), 1)
+        self.assertEqual(test.id, '123')
+        self.assertEqual(test.document['references'], 2)
+        with self.assertRaises(AttributeError):
+            test.missing
+
+    def testIdleHandlesAreCompact(self):
+        fact = File(id='foo')
+        self.assertNotIn('_reference_queryset', fact.__dict__)
+        self.assertNotIn('_annotation_queryset', fact.__dict__)
+        self.assertIsNone(fact.__dict__['_document'])
+
+        self.assertIs(fact.references, fact.references)
+        self.assertIs(fact.annotations, fact.annotations)
+        self.assertEqual(fact.document, {})
+
     def testFactAnnotations(self):
         session = MagicMock()
         TestFactModel(id="123", session=session).annotations()
@@ -87,7 +139,7 @@ class TestPyQuo(unittest.TestCase):
         session = MagicMock()
 
         # set_global_session(session)
-        session._query.return_value = [{
+        records = [{
             'class': 'reference',
             'type': 'contains',
             'target': self.fileObj.serialize,
@@ -98,6 +150,13 @@ class TestPyQuo(unittest.TestCase):
             'target': self.urlObj.serialize,
             'source': self.fileObj.serialize
         }]
+
+        def query(query):
+            offset = query.get('offset', 0)
+            limit = query.get('limit', len(records))
+            return [dict(r) for r in records[offset:offset + limit]]
+
+        session._query.side_effect = query
         self.fileObj._session = session
 
         for incoming in (True, False):
@@ -157,15 +216,34 @@ class FileUploadTestCase(unittest.TestCase):
         def __init__(self, content, name=None):
             self.name = name
             self.content = content
+            self.reads = 0
 
-        def read(self):
-            return self.content
+        def read(self, size=-1):
+            if size < 0:
+                size = len(self.content)
+            chunk, self.content = self.content[:size], self.content[size:]
+            self.reads += 1
+            return chunk
 
     def setUp(self):
         self.session = MagicMock(spec=Session)
+        self.session.http_post.side_effect = self.post
+        self.posted = []
         self.content = 'testcontent'
         self.filename = 'testname'
 
+    def post(self, path, data=None, headers={}):
+        # consume streamed bodies like requests does
+        if not isinstance(data, bytes):
+            data = b''.join(data)
+        self.posted.append((path, data, headers))
+        return MagicMock()
+
+    def assertUploaded(self, content):
+        self.assertEqual(self.posted, [(
+            '/v1/file', content,
+            {'Content-Type': 'application/octet-stream'})])
+
     # def tearDown(self):
     #     base.Model._session = None
 
@@ -179,10 +257,7 @@ class FileUploadTestCase(unittest.TestCase):
         }
         File.upload(self.content, filename=self.filename, session=self.session)
 
-        self.session.http_post.assert_called_once_with(
-            '/v1/file', data=self.content,
-            headers={'Content-Type': 'application/octet-stream'})
-        self.assertEqual(self.session.http_post.call_count, 1)
+        self.assertUploaded(b'testcontent')
 
         label = self.session._import.call_args[0][0]['annotation'][0]['label']
         # print('jjjjjjjj', annot)
@@ -192,9 +267,7 @@ class FileUploadTestCase(unittest.TestCase):
         self.session.http_post.json.return_value = {'records': [{'id': '123'}]}
         File.upload(self.content, session=self.session)
 
-        self.session.http_post.assert_called_once_with(
-            '/v1/file', data=self.content,
-            headers={'Content-Type': 'application/octet-stream'})
+        self.assertUploaded(b'testcontent')
         self.session._import.assert_not_called()
 
     def testSaveWithFileLikeOjectShouldTryToExtractFilename(self):
@@ -211,9 +284,7 @@ class FileUploadTestCase(unittest.TestCase):
             session=self.session
         )
 
-        self.session.http_post.assert_called_once_with(
-            '/v1/file', data=self.content,
-            headers={'Content-Type': 'application/octet-stream'})
+        self.assertUploaded(b'testcontent')
         self.assertEqual(self.session._import.call_count, 1)
 
         label = self.session._import.call_args[0][0]['annotation'][0]['label']
@@ -233,9 +304,7 @@ class FileUploadTestCase(unittest.TestCase):
             session=self.session
         )
 
-        self.session.http_post.assert_called_once_with(
-            '/v1/file', data=self.content,
-            headers={'Content-Type': 'application/octet-stream'})
+        self.assertUploaded(b'testcontent')
 
         label = self.session._import.call_args[0][0]['annotation'][0]['label']
         self.assertEqual(label, FILENAME)
@@ -266,6 +335,450 @@ class FileUploadTestCase(unittest.TestCase):
         File.upload(self.FakeFile(self.content, self.filename),
                     session=session)
 
+    def testUploadIsStreamedAndHashed(self):
+        content = os.urandom(10000)
+        file_obj = self.FakeFile(content)
+        f = File.upload(file_obj, session=self.session, chunk_size=1024)
+
+        self.assertUploaded(content)
+        # 10 chunks and the final empty read
+        self.assertEqual(file_obj.reads, 11)
+        self.assertEqual(f.hashes, {
+            'md5': hashlib.md5(content).hexdigest(),
+            'sha1': hashlib.sha1(content).hexdigest(),
+            'sha256': hashlib.sha256(content).hexdigest(),
+        })
+
+    def testUploadedBytesAreHashed(self):
+        f = File.upload(b'content', session=self.session)
+        self.assertEqual(f.hashes['sha256'],
+                         hashlib.sha256(b'content').hexdigest())
+
+    def fetch(self, existing):
+        def fetch(objects, strict=True):
+            for obj in objects:
+                obj._fetched = obj.id in existing
+            return objects
+        self.session.fetch.side_effect = fetch
+
+    def testDedupeSkipsExistingFile(self):
+        content = os.urandom(1000)
+        sha256 = hashlib.sha256(content).hexdigest()
+        self.fetch({sha256})
+        self.session._import.return_value = {
+            "annotation": [{
+                "type": "known-as",
+                "label": self.filename,
+                "fact": File(id=sha256).serialize
+            }]
+        }
+
+        f = File.upload(io.BytesIO(content), filename=self.filename,
+                        dedupe=True, session=self.session)
+
+        self.assertEqual(self.posted, [])
+        self.assertEqual(f.id, sha256)
+        self.assertEqual(f.hashes['md5'], hashlib.md5(content).hexdigest())
+        self.assertEqual(self.session.fetch.call_count, 1)
+
+        label = self.session._import.call_args[0][0]['annotation'][0]['label']
+        self.assertEqual(label, self.filename)
+
+    def testDedupeUploadsMissingFile(self):
+        content = os.urandom(1000)
+        self.fetch(set())
+
+        file_obj = io.BytesIO(content)
+        file_obj.seek(10)
+        File.upload(file_obj, dedupe=True, session=self.session)
+
+        self.assertUploaded(content[10:])
+
+    def testDedupeWithoutSeekableFile(self):
+        File.upload(self.FakeFile(self.content), dedupe=True,
+                    session=self.session)
+
+        self.session.fetch.assert_not_called()
+        self.assertUploaded(b'testcontent')
+
+
+class UploadMany(unittest.TestCase):
+    def setUp(self):
+        self.session = MagicMock(spec=Session)
+        self.session.http_post.side_effect = self.post
+        self.session.decode.side_effect = lambda res: res
+        self.session.fetch.side_effect = self.fetch
+        self.posted = []
+        self.fetched = []
+        self.existing = set()
+        self.lock = threading.Lock()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.contents = [os.urandom(1000 + i) for i in range(5)]
+        self.paths = []
+        for i, content in enumerate(self.contents):
+            path = os.path.join(self.tmp.name, 'sample-{}.bin'.format(i))
+            with open(path, 'wb') as fp:
+                fp.write(content)
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def post(self, path, data=None, headers={}):
+        data = b''.join(data)
+        if data == b'fail':
+            raise FetchError('upload failed', 500)
+
+        with self.lock:
+            self.posted.append(data)
+        return {'records': [{'id': hashlib.sha256(data).hexdigest()}]}
+
+    def fetch(self, objects, strict=True):
+        self.fetched.append([obj.id for obj in objects])
+        for obj in objects:
+            obj._fetched = obj.id in self.existing or not self.existing
+        return objects
+
+    def sha256(self, content):
+        return hashlib.sha256(content).hexdigest()
+
+    def testUploadMany(self):
+        progress = []
+        results = File.upload_many(
+            self.paths, workers=3, session=self.session,
+            progress=lambda done, total, r: progress.append((done, total)))
+
+        self.assertEqual([r.source for r in results], self.paths)
+        self.assertEqual([r.file.id for r in results],
+                         [self.sha256(c) for c in self.contents])
+        self.assertTrue(all(r.error is None for r in results))
+        self.assertEqual(sorted(self.posted), sorted(self.contents))
+        self.assertEqual(progress, [(i, 5) for i in range(1, 6)])
+
+        # a single batched fetch and import
+        self.assertEqual(self.fetched, [[r.file.id for r in results]])
+        annotations = self.session.bulk_import.call_args[0][0]
+        self.assertEqual([a.label for a in annotations],
+                         [os.path.basename(p) for p in self.paths])
+        self.assertEqual(self.session.bulk_import.call_count, 1)
+
+    def testErrorsDoNotStopTheBatch(self):
+        sources = [io.BytesIO(b'fail'), self.paths[0],
+                   os.path.join(self.tmp.name, 'missing')]
+        results = File.upload_many(sources, session=self.session)
+
+        self.assertIsInstance(results[0].error, FetchError)
+        self.assertIsNone(results[0].file)
+        self.assertEqual(results[1].file.id, self.sha256(self.contents[0]))
+        self.assertIsInstance(results[2].error, IOError)
+        self.assertEqual(self.posted, [self.contents[0]])
+
+    def testDedupe(self):
+        self.existing = {self.sha256(c) for c in self.contents[:3]}
+        results = File.upload_many(self.paths, dedupe=True,
+                                   session=self.session)
+
+        self.assertEqual(sorted(self.posted), sorted(self.contents[3:]))
+        self.assertEqual([r.file.id for r in results],
+                         [self.sha256(c) for c in self.contents])
+        self.assertEqual(results[0].file.hashes['sha256'],
+                         self.sha256(self.contents[0]))
+        # one existence check for all files
+        self.assertEqual(len(self.fetched[0]), 5)
+
+    def testBatchedImportFails(self):
+        error = FetchError('import failed', 503)
+        self.session.bulk_import.side_effect = error
+        results = File.upload_many(self.paths, session=self.session)
+
+        self.assertEqual([r.file.id for r in results],
+                         [self.sha256(c) for c in self.contents])
+        self.assertTrue(all(r.error is error for r in results))
+
+    def testBatchedFetchFails(self):
+        error = FetchError('query failed', 500)
+        self.session.fetch.side_effect = error
+        results = File.upload_many(self.paths[:2], session=self.session)
+
+        self.assertTrue(all(r.error is error for r in results))
+        self.assertEqual(self.session.bulk_import.call_count, 1)
+
+    def testUploadedFileNotFound(self):
+        self.existing = {self.sha256(self.contents[0])}
+        results = File.upload_many(self.paths[:2], session=self.session)
+
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, ResultNotFound)
+        self.assertEqual(results[1].file.id, self.sha256(self.contents[1]))
+
+
+class SimilarFunctions(unittest.TestCase):
+    def setUp(self):
+        self.session = MagicMock(spec=Session)
+        self.session.http_get.side_effect = self.get
+        self.session.decode.side_effect = lambda res: res
+        self.session.fetch.side_effect = self.fetch
+        self.paths = []
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            self.paths.append(path)
+        match = re.match(r'/v1/function/(\w+)/similar\?limit=(\d+)'
+                         r'&offset=(\d+)', path)
+        id, limit, offset = match.groups()
+        limit, offset, count = int(limit), int(offset), int(id[1:])
+        records = [{'id': '{}-{}'.format(id, i), 'score': 1.0 / (i + 1)}
+                   for i in range(count)]
+        return {'records': records[offset:offset + limit]}
+
+    def fetch(self, objects, strict=True):
+        self.fetched.append([obj.id for obj in objects])
+        for obj in objects:
+            obj._fetched = True
+        return objects
+
+    def testSimilarMany(self):
+        functions = [Function(id='f{}'.format(i)) for i in (0, 3, 12)]
+        results = Function.similar_many(functions, workers=2, page_size=5,
+                                        session=self.session)
+
+        self.assertEqual([len(matches) for matches in results], [0, 3, 12])
+        self.assertEqual(results[2][1].function.id, 'f12-1')
+        self.assertEqual(results[2][1].score, 0.5)
+        self.assertTrue(results[2][1].function._fetched)
+        # three pages for 12 matches
+        self.assertEqual(len([p for p in self.paths if '/f12/' in p]), 3)
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual(len(self.fetched[0]), 15)
+
+    def testServerWithoutPaging(self):
+        self.session.http_get.side_effect = lambda path: {
+            'records': [{'id': 'a'}, {'id': 'b'}]}
+        results = Function.similar_many([Function(id='f')], page_size=2,
+                                        fetch=False, session=self.session)
+
+        self.assertEqual([m.function.id for m in results[0]], ['a', 'b'])
+        self.assertIsNone(results[0][0].score)
+        self.assertEqual(self.session.http_get.call_count, 2)
+        self.session.fetch.assert_not_called()
+
+    def testDuplicatesAcrossPages(self):
+        records = [{'id': id} for id in ('a', 'b', 'b', 'a', 'c')]
+
+        def get(path):
+            offset = int(path.rsplit('=', 1)[1])
+            return {'records': records[offset:offset + 2]}
+
+        self.session.http_get.side_effect = get
+        results = Function.similar_many([Function(id='f')], page_size=2,
+                                        fetch=False, session=self.session)
+
+        self.assertEqual([m.function.id for m in results[0]],
+                         ['a', 'b', 'c'])
+        self.assertEqual(self.session.http_get.call_count, 3)
+
+
+class FakeGraph(object):
+    """Stand-in for Session._query answering reference queries from a list
+    of (source, target) edges"""
+    edges = [
+        (('file', 'f'), ('url', 'u1')),
+        (('file', 'f'), ('url', 'u2')),
+        (('url', 'u1'), ('hostname', 'h')),
+        (('url', 'u2'), ('hostname', 'h')),
+        (('hostname', 'h'), ('ip-address', 'i')),
+        (('ip-address', 'i'), ('file', 'f')),
+    ]
+
+    @staticmethod
+    def listed(value):
+        return value if isinstance(value, list) else [value]
+
+    def __call__(self, query):
+        if query['class'] != 'reference':
+            return []
+
+        key, other = 'source', 'target'
+        if not all('id' in fact for fact in self.listed(query.get(key, {}))):
+            key, other = other, key
+
+        anchors = set((f['type'], f['id']) for f in self.listed(query[key]))
+        types = None
+        if other in query:
+            types = set(f['type'] for f in self.listed(query[other]))
+
+        records = []
+        for source, target in self.edges:
+            record = {
+                'class': 'reference',
+                'type': 'contains',
+                'source': {'type': source[0], 'id': source[1]},
+                'target': {'type': target[0], 'id': target[1]},
+            }
+            if (record[key]['type'], record[key]['id']) not in anchors:
+                continue
+            if types is not None and record[other]['type'] not in types:
+                continue
+            records.append(record)
+
+        offset = query.get('offset', 0)
+        end = None if query.get('limit') is None else \
+            offset + query['limit']
+        return records[offset:end]
+
+
+class GraphTraversal(unittest.TestCase):
+    def setUp(self):
+        self.session = MagicMock(spec=Session)
+        self.session._query.side_effect = FakeGraph()
+        self.root = File(id='f', session=self.session)
+
+    def ids(self, subgraph):
+        return [sorted(fact.id for fact in level)
+                for level in subgraph.levels]
+
+    def testTraverse(self):
+        subgraph = self.root.traverse(depth=4, refs=[Reference])
+
+        self.assertEqual(self.ids(subgraph),
+                         [['f'], ['u1', 'u2'], ['h'], ['i']])
+        self.assertEqual(len(subgraph.references), 6)
+        self.assertEqual(subgraph.depth(URL(id='u2')), 1)
+        self.assertIn(File(id='f'), subgraph)
+        self.assertFalse(subgraph.truncated)
+        # one query per level, the last one finds visited facts only
+        self.assertEqual(subgraph.queries, 4)
+
+        frontier = self.session._query.call_args_list[1][0][0]['source']
+        self.assertEqual(sorted(fact['id'] for fact in frontier),
+                         ['u1', 'u2'])
+
+    def testDefaultReferenceClasses(self):
+        subgraph = self.root.traverse(depth=2)
+        self.assertEqual(self.ids(subgraph), [['f'], ['u1', 'u2'], ['h']])
+        self.assertEqual(subgraph.queries, 4)
+
+    def testIncomingAndBoth(self):
+        ip = IpAddress(id='i', session=self.session)
+        subgraph = ip.traverse(depth=2, refs=[Reference], incoming=True)
+        self.assertEqual(self.ids(subgraph), [['i'], ['h'], ['u1', 'u2']])
+
+        subgraph = ip.traverse(depth=1, refs=[Reference], incoming=None)
+        self.assertEqual(self.ids(subgraph), [['i'], ['f', 'h']])
+
+    def testFactsFilter(self):
+        subgraph = self.root.traverse(depth=3, refs=[Reference],
+                                      facts=[URL, Hostname])
+        self.assertEqual(self.ids(subgraph), [['f'], ['u1', 'u2'], ['h']])
+
+    def testFanoutAndChunks(self):
+        subgraph = self.root.traverse(depth=1, refs=[Reference],
+                                      max_fanout=1)
+        self.assertEqual(len(subgraph.levels[1]), 1)
+        self.assertTrue(subgraph.truncated)
+
+        subgraph = self.root.traverse(depth=2, refs=[Reference],
+                                      chunk_size=1)
+        self.assertEqual(subgraph.queries, 3)
+
+    def testFanoutPerFact(self):
+        graph = FakeGraph()
+        graph.edges = [(('file', 'f'), ('url', 'hub')),
+                       (('file', 'f'), ('url', 'small'))]
+        graph.edges += [(('url', 'hub'), ('hostname', str(i)))
+                        for i in range(5)]
+        graph.edges += [(('url', 'small'), ('hostname', 'leaf'))]
+        self.session._query.side_effect = graph
+
+        subgraph = self.root.traverse(depth=2, refs=[Reference],
+                                      max_fanout=2)
+        self.assertEqual(self.ids(subgraph)[2], ['0', '1', 'leaf'])
+        self.assertTrue(subgraph.truncated)
+
+
+class GraphStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.session = MagicMock(spec=Session)
+        self.session._query.side_effect = FakeGraph()
+        self.session.graph_store = GraphStore()
+
+    def file(self):
+        return File(id='f', session=self.session)
+
+    def ids(self, facts):
+        return sorted(fact.id for fact in facts)
+
+    def testReferencesAreStored(self):
+        self.assertEqual(len(self.file().references()), 2)
+        self.assertEqual(self.session._query.call_count, 2)
+
+        # answered from the store, including the filters and the window
+        self.assertEqual(self.ids(self.file().descendants), ['u1', 'u2'])
+        self.assertEqual(len(self.file().references(facts=[URL])), 2)
+        self.assertEqual(len(self.file().references(facts=[Hostname])), 0)
+        self.assertEqual(len(self.file().references()[1:]), 1)
+        self.assertEqual(self.session._query.call_count, 2)
+        self.assertEqual(self.session.graph_store.hits, 8)
+
+        # incoming references were not loaded
+        self.assertEqual(self.ids(self.file().ancestors), ['i'])
+        self.assertEqual(self.session._query.call_count, 4)
+
+    def testBoundQueriesAreNotStored(self):
+        self.file().references(limit=1)[0]
+        self.file().references(facts=[URL])[0]
+        self.assertEqual(len(self.session.graph_store), 0)
+
+        self.file().references()[0]
+        self.assertEqual(self.session._query.call_count, 6)
+
+    def testTraversePopulatesStore(self):
+        self.file().traverse(depth=2, refs=[Reference])
+        count = self.session._query.call_count
+
+        url = URL(id='u1', session=self.session)
+        self.assertEqual(self.ids(url.references(refs=[Reference]).facts),
+                         ['h'])
+        self.assertEqual(self.session._query.call_count, count)
+
+        # hostnames were reached, but not expanded
+        hostname = Hostname(id='h', session=self.session)
+        self.assertEqual(
+            self.ids(hostname.references(refs=[Reference]).facts), ['i'])
+        self.assertEqual(self.session._query.call_count, count + 1)
+
+    def testRefreshBypassesStore(self):
+        references = self.file().references()
+        list(references)
+        self.assertEqual(self.session._query.call_count, 2)
+
+        list(references.refresh())
+        self.assertEqual(self.session._query.call_count, 4)
+
+    def testDisabledCacheBypassesStore(self):
+        list(self.file().references())
+        references = self.file().references().cache(False)
+        for _ in range(2):
+            self.assertEqual(len(references), 2)
+        self.assertEqual(self.session._query.call_count, 6)
+
+    def testFreshness(self):
+        self.session.graph_store.ttl = 0
+        list(self.file().references())
+        list(self.file().references())
+        self.assertEqual(self.session._query.call_count, 4)
+
+    def testInvalidation(self):
+        list(self.file().references())
+        reference = self.file().references()[0]
+        reference.delete(session=self.session)
+
+        list(self.file().references())
+        self.assertEqual(self.session._query.call_count, 4)
+
 
 class ModelFilter(unittest.TestCase):
     def testFilter(self):
@@ -282,6 +795,1031 @@ class ModelFilter(unittest.TestCase):
             self.assertIsInstance(i, TestFactModel)
 
 
+class QuerySetCache(unittest.TestCase):
+    def setUp(self):
+        self.session = MagicMock()
+        self.session._query.return_value = [{
+            'class': 'reference',
+            'type': 'contains',
+            'target': File(id='a').serialize,
+            'source': URL(id='b').serialize
+        }]
+        self.fact = File(id='a', session=self.session)
+
+    def testResultsAreCached(self):
+        references = self.fact.references(refs=Reference)
+        len(references)
+        repr(references)
+        references[0]
+        list(references)
+        self.assertEqual(self.session._query.call_count, 1)
+
+        references.refresh()
+        len(references)
+        self.assertEqual(self.session._query.call_count, 2)
+
+    def testChangedParametersInvalidateCache(self):
+        references = self.fact.references(refs=Reference)
+        len(references)
+        len(self.fact.references(refs=Reference))
+        self.assertEqual(self.session._query.call_count, 1)
+
+        len(self.fact.references(refs=Reference, incoming=True))
+        self.assertEqual(self.session._query.call_count, 2)
+
+    def testCacheOptOut(self):
+        references = self.fact.references(refs=Reference).cache(False)
+        len(references)
+        len(references)
+        self.assertEqual(self.session._query.call_count, 2)
+
+    def testFactsShareCache(self):
+        # one query per reference class
+        list(self.fact.descendants)
+        list(self.fact.descendants)
+        len(self.fact.references)
+        self.assertEqual(self.session._query.call_count, 2)
+
+        self.fact.descendants.refresh()
+        list(self.fact.descendants)
+        self.assertEqual(self.session._query.call_count, 4)
+
+    def testFactsCacheOptOut(self):
+        self.fact.descendants.cache(False)
+        len(self.fact.references)
+        len(self.fact.descendants)
+        self.assertEqual(self.session._query.call_count, 4)
+
+    def testAnnotationsAreCached(self):
+        self.session._query.return_value = []
+        annotations = self.fact.annotations(limit=2)
+        len(annotations)
+        list(annotations)
+        self.assertEqual(self.session._query.call_count, 1)
+
+
+class QuerySetSlicing(unittest.TestCase):
+    def setUp(self):
+        self.session = MagicMock()
+        self.session._query.return_value = [{
+            'class': 'reference',
+            'type': 'contains',
+            'target': File(id='a').serialize,
+            'source': URL(id='b').serialize
+        }]
+        self.fact = File(id='a', session=self.session)
+
+    def testSliceIsSentToServer(self):
+        self.fact.references(refs=Reference)[5:15]
+        query = self.session._query.call_args[0][0]
+        self.assertEqual(query['limit'], 10)
+        self.assertEqual(query['offset'], 5)
+
+    def testIndexIsSentToServer(self):
+        reference = self.fact.references(refs=Reference)[3]
+        self.assertEqual(reference.target, File(id='a'))
+        query = self.session._query.call_args[0][0]
+        self.assertEqual(query['limit'], 1)
+        self.assertEqual(query['offset'], 3)
+
+        self.session._query.return_value = []
+        with self.assertRaises(IndexError):
+            self.fact.references(refs=Reference)[4]
+
+    def testSliceIsBoundByLimit(self):
+        self.fact.references(refs=Reference, limit=4)[2:10]
+        query = self.session._query.call_args[0][0]
+        self.assertEqual(query['limit'], 2)
+
+    def testSliceOverSeveralReferenceClasses(self):
+        references = self.fact.references()[1:3]
+        self.assertEqual(len(references), 1)
+        query = self.session._query.call_args_list[0][0][0]
+        self.assertEqual(query['limit'], 3)
+        self.assertNotIn('offset', query)
+
+    def testNegativeIndexFetchesEverything(self):
+        self.fact.references(refs=Reference)[-1]
+        self.assertNotIn('limit', self.session._query.call_args[0][0])
+
+    def testAnnotationSlice(self):
+        self.session._query.return_value = []
+        self.fact.annotations()[10:20]
+        query = self.session._query.call_args[0][0]
+        self.assertEqual(query['limit'], 10)
+        self.assertEqual(query['offset'], 10)
+
+
+class BulkImport(unittest.TestCase):
+    def setUp(self):
+        self.session = Session(base_url='http://localhost/')
+        self.session._import = MagicMock(side_effect=self._import)
+
+    @staticmethod
+    def _import(query):
+        result = {}
+        for cl, records in query.items():
+            result[cl] = [dict(record) for record in records]
+            for record in result[cl]:
+                record.pop('class')
+        return result
+
+    def testBulkImportPreservesOrder(self):
+        objects = [
+            File(id='a'),
+            KnownAs(File(id='a'), 'a.exe'),
+            URL(id='http://b'),
+            KnownAs(File(id='c'), 'c.exe'),
+        ]
+        results = Fact.save_many(objects, session=self.session)
+
+        self.assertEqual(self.session._import.call_count, 2)
+        self.assertEqual(results[0], File(id='a'))
+        self.assertEqual(results[1].label, 'a.exe')
+        self.assertEqual(results[2], URL(id='http://b'))
+        self.assertEqual(results[3].label, 'c.exe')
+
+    def testBulkImportChunks(self):
+        objects = [File(id=str(i)) for i in range(5)]
+        results = self.session.bulk_import(objects, chunk_size=2)
+
+        self.assertEqual(self.session._import.call_count, 3)
+        self.assertEqual(results, objects)
+
+    def testBulkImportChecksRequiredFields(self):
+        objects = [File(id='a'), TestFactModel(id='b')]
+        with self.assertRaises(RequiredError):
+            self.session.bulk_import(objects)
+        self.session._import.assert_not_called()
+
+
+class BatchedFetch(unittest.TestCase):
+    def setUp(self):
+        self.session = Session(base_url='http://localhost/')
+        self.session._query = MagicMock(side_effect=self._query)
+
+    @staticmethod
+    def _query(query):
+        return [{
+            'class': query['class'],
+            'type': query['type'],
+            'id': id,
+            'document': {'name': id}
+        } for id in query['id'] if id != 'missing']
+
+    def testGetMany(self):
+        ids = [str(i) for i in range(5)]
+        facts = TestFactModel.get_many(ids, session=self.session)
+
+        self.assertEqual(self.session._query.call_count, 1)
+        self.assertEqual([fact.name for fact in facts], ids)
+
+    def testFetchGroupsByType(self):
+        objects = [File(id='a'), URL(id='b'), File(id='c'), File(id='a')]
+        self.session.fetch(objects, chunk_size=1)
+
+        self.assertEqual(self.session._query.call_count, 3)
+        self.assertEqual(objects[3].document, {'name': 'a'})
+        queries = [c[0][0] for c in self.session._query.call_args_list]
+        self.assertEqual(queries[0]['id'], ['a'])
+        self.assertEqual(queries[2]['type'], 'url')
+
+    def testFetchMissing(self):
+        with self.assertRaises(ResultNotFound):
+            self.session.fetch([File(id='a'), File(id='missing')])
+
+        objects = self.session.fetch(
+            [File(id='a'), File(id='missing')], strict=False)
+        self.assertEqual(objects[1].document, {})
+
+
+class PrefetchRelated(unittest.TestCase):
+    def setUp(self):
+        self.session = Session(base_url='http://localhost/')
+        self.session._query = MagicMock(side_effect=self._query)
+        self.fact = TestFactModel(id='root', session=self.session)
+
+    @staticmethod
+    def _query(query):
+        if 'id' in query:
+            return BatchedFetch._query(query)
+
+        records = [{
+            'class': 'reference',
+            'type': 'contains',
+            'source': TestFactModel(id='root').serialize,
+            'target': TestFactModel(id=str(i)).serialize
+        } for i in range(10)]
+        offset = query.get('offset', 0)
+        return records[offset:offset + query.get('limit', len(records))]
+
+    def testSelectRelated(self):
+        descendants = self.fact.descendants(refs=Reference).select_related()
+        names = [fact.name for fact in descendants]
+
+        self.assertEqual(names, [str(i) for i in range(10)])
+        self.assertEqual(self.session._query.call_count, 2)
+
+        # fields missing from fetched documents are not fetched again
+        self.assertIs(descendants[0].number, Unset)
+        self.assertEqual(self.session._query.call_count, 2)
+
+    def testAnnotationsHaveNoSelectRelated(self):
+        self.assertFalse(hasattr(self.fact.annotations, 'select_related'))
+
+    def testPrefetchParameter(self):
+        references = self.fact.references(refs=Reference, prefetch=True)
+        self.assertEqual(references[2].target.name, '2')
+        self.assertEqual(self.session._query.call_count, 2)
+
+
+class IdentityMapTestCase(unittest.TestCase):
+    reference = {
+        'class': 'reference',
+        'type': 'contains',
+        'source': {'class': 'fact', 'type': 'url', 'id': 'http://a'},
+        'target': {'class': 'fact', 'type': 'file', 'id': 'b'}
+    }
+
+    def testLRUEviction(self):
+        identity_map = IdentityMap(maxsize=2)
+        identity_map.add('a', 1)
+        identity_map.add('b', 2)
+        self.assertEqual(identity_map.get('a'), 1)
+        identity_map.add('c', 3)
+
+        self.assertIn('a', identity_map)
+        self.assertNotIn('b', identity_map)
+        self.assertIsNone(identity_map.get('b'))
+        self.assertEqual((identity_map.hits, identity_map.misses), (1, 1))
+
+        identity_map.clear()
+        self.assertEqual(len(identity_map), 0)
+
+    def testDisabledByDefault(self):
+        session = Session(base_url='http://localhost/')
+        a = TypeFactory.deserialize(self.reference, session)
+        b = TypeFactory.deserialize(self.reference, session)
+        self.assertIsNot(a, b)
+        self.assertEqual(len(session.identity_map), 0)
+
+    def testSingleInstancePerIdentity(self):
+        session = Session(base_url='http://localhost/', identity_map_size=10)
+        a = TypeFactory.deserialize(self.reference, session)
+        b = TypeFactory.deserialize(self.reference, session)
+        fact = TypeFactory.deserialize(
+            dict(self.reference['target'], document={'size': 1}), session)
+
+        self.assertIs(a, b)
+        self.assertIs(a.target, fact)
+        self.assertEqual(fact.document, {'size': 1})
+        self.assertEqual(session.identity_map.hits, 2)
+        self.assertIs(fact._session, session)
+
+
+class LazyDocuments(unittest.TestCase):
+    record = {
+        'class': 'fact',
+        'type': 'testfact',
+        'id': '1',
+        'document': {'name': 'foo', 'number': 'not a number', 'extra': 1}
+    }
+
+    def setUp(self):
+        self.session = Session(base_url='http://localhost/',
+                               lazy_documents=True)
+
+    def testFieldsAreAssignedOnFirstAccess(self):
+        fact = TypeFactory.deserialize(dict(self.record), self.session)
+        self.assertTrue(fact._pending)
+        self.assertEqual(fact.extra, 1)
+        self.assertTrue(fact._pending)
+
+        with self.assertRaises(ValidationError):
+            fact.name
+
+    def testAssignmentIsNotOverwritten(self):
+        record = dict(self.record, document={'name': 'foo', 'number': 1})
+        fact = TypeFactory.deserialize(record, self.session)
+        fact.name = 'bar'
+        self.assertEqual(fact.name, 'bar')
+        self.assertEqual(fact.number, 1)
+
+    def testGlobalDefault(self):
+        session = Session(base_url='http://localhost/')
+        with self.assertRaises(ValidationError):
+            TypeFactory.deserialize(dict(self.record), session)
+
+        TypeFactory.lazy_documents = True
+        try:
+            fact = TypeFactory.deserialize(dict(self.record), session)
+        finally:
+            TypeFactory.lazy_documents = False
+        self.assertTrue(fact._pending)
+
+
+class TrustedResponses(unittest.TestCase):
+    record = {
+        'class': 'fact',
+        'type': 'testfact',
+        'id': '1',
+        'document': {'name': 'foo', 'number': 'not a number'}
+    }
+
+    def testValidatorsAreSkipped(self):
+        session = Session(base_url='http://localhost/', trusted=True)
+        fact = TypeFactory.deserialize(dict(self.record), session)
+        self.assertEqual(fact.number, 'not a number')
+
+        with self.assertRaises(ValidationError):
+            fact.number = 'still not a number'
+
+    def testLazyAndTrusted(self):
+        session = Session(base_url='http://localhost/', trusted=True,
+                          lazy_documents=True)
+        fact = TypeFactory.deserialize(dict(self.record), session)
+        self.assertTrue(fact._pending)
+        self.assertEqual(fact.number, 'not a number')
+
+    def testFetchedDocumentsAreTrusted(self):
+        session = Session(base_url='http://localhost/', trusted=True)
+        session._query = MagicMock(return_value=[dict(self.record)])
+        fact = TestFactModel(id='1', session=session).get()
+        self.assertEqual(fact.number, 'not a number')
+
+
+class PhantomClasses(unittest.TestCase):
+    def testPhantomClassesAreMemoized(self):
+        record = {'class': 'fact', 'type': 'unmodelled-type', 'id': '1'}
+
+        with self.assertLogs('pyquo.helper', 'WARNING') as logs:
+            a = TypeFactory.deserialize(dict(record))
+            b = TypeFactory.deserialize(dict(record, id='2'))
+            c = TypeFactory.deserialize(dict(record, **{'class': 'sysfact'}))
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIs(type(a), type(b))
+        self.assertIsInstance(b, type(a))
+        self.assertIsNot(type(a), type(c))
+        self.assertIs(phantom_registry[('unmodelled-type', 'fact')], type(a))
+
+
+class StreamingQuery(unittest.TestCase):
+    records = [
+        {'class': 'fact', 'type': 'file', 'id': str(i), 'document': {}}
+        for i in range(10)
+    ]
+
+    def chunks(self, size=7):
+        data = json.dumps({'more': [1, {'a': None}], 'records': self.records,
+                           'total': 10}).encode()
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def response(self):
+        response = MagicMock(status_code=200)
+        response.iter_content.return_value = iter(self.chunks())
+        return response
+
+    def testIterRecords(self):
+        for size in (1, 3, 1000):
+            self.assertEqual(list(iter_records(self.chunks(size))),
+                             self.records)
+
+        with self.assertRaises(ValueError):
+            list(iter_records([b'{"records": [{"id": 1}']))
+
+    def testNumbersSplitAtEveryOffset(self):
+        data = json.dumps({
+            'took': 1.5, 'records': [1.25, -3e10, {'score': 0.5}, 2E-3, 7],
+            'total': 12.0,
+        }).encode()
+        expected = [1.25, -3e10, {'score': 0.5}, 2E-3, 7]
+
+        for i in range(1, len(data)):
+            self.assertEqual(list(iter_records([data[:i], data[i:]])),
+                             expected, data[:i])
+
+        chunks = [b'{"took": 1.', b'5, "records": [{"id": "a"}]}']
+        self.assertEqual(list(iter_records(chunks)), [{'id': 'a'}])
+        self.assertEqual(list(iter_records([b'{"records": [1.', b'5]}'])),
+                         [1.5])
+
+    def testQueryStreamIsLazy(self):
+        session = Session(base_url='http://localhost/')
+        session.http_post = MagicMock(return_value=self.response())
+
+        records = session._query({'class': 'fact'}, stream=True)
+        session.http_post.assert_not_called()
+
+        self.assertEqual(next(records), self.records[0])
+        self.assertTrue(session.http_post.call_args[1]['stream'])
+
+        session.http_post.return_value = self.response()
+        results = list(Query.generate({'class': 'fact'}, session, stream=True))
+        self.assertEqual(results[9], File(id='9'))
+
+    def testFilterAndMagicParserStream(self):
+        session = Session(base_url='http://localhost/')
+        session.http_post = MagicMock(side_effect=lambda *a, **kw:
+                                      self.response())
+
+        results = File.filter(session=session, stream=True)
+        self.assertEqual(len(list(results)), 10)
+
+        results = MagicParser.parse('text', session=session, stream=True)
+        self.assertEqual(len(list(results)), 10)
+
+
+class BatchMagicParser(unittest.TestCase):
+    def setUp(self):
+        self.session = Session(base_url='http://localhost/')
+        self.session.http_post = MagicMock(side_effect=self.scan)
+        self.scanned = []
+        self.lock = threading.Lock()
+
+    def scan(self, path, json=None):
+        with self.lock:
+            self.scanned.append(json['text'])
+        records = [{'class': 'fact', 'type': 'hostname', 'id': token}
+                   for token in re.findall(r'\S+\.com', json['text'])]
+        content = self.session.codec.dumps({'records': records})
+        return MagicMock(status_code=200, content=content)
+
+    def text(self, count):
+        return ' '.join('word-{} host-{}.com'.format(i, i % 100)
+                        for i in range(count))
+
+    def testSplitText(self):
+        text = self.text(1000)
+        chunks = list(split_text(text, chunk_size=1000, overlap=100))
+
+        self.assertTrue(all(len(chunk) <= 1000 for chunk in chunks))
+        tokens = set(text.split())
+        for chunk in chunks:
+            self.assertTrue(set(chunk.split()) <= tokens)
+        # consecutive chunks overlap
+        for a, b in zip(chunks, chunks[1:]):
+            self.assertIn(b.split()[0], a.split()[-10:])
+        self.assertEqual(set(''.join(chunks).split()), tokens)
+
+        with self.assertRaises(ValueError):
+            list(split_text(text, chunk_size=100, overlap=50))
+
+    def testSplitWithoutWhitespace(self):
+        text = 'x' * 2500
+        chunks = list(split_text(text, chunk_size=1000, overlap=100))
+        self.assertEqual([len(c) for c in chunks], [1000, 1000, 700])
+
+    def testParseMany(self):
+        texts = [self.text(1000), self.text(500), '']
+        results = list(MagicParser.parse_many(
+            iter(texts), session=self.session, chunk_size=2000,
+            overlap=200))
+
+        self.assertEqual(sorted(f.id for f in results),
+                         sorted('host-{}.com'.format(i) for i in range(100)))
+        self.assertGreater(len(self.scanned), 10)
+        self.assertTrue(all(len(text) <= 2000 for text in self.scanned))
+
+    def testParseManyStreams(self):
+        results = MagicParser.parse_many(self.text(10000),
+                                         session=self.session,
+                                         chunk_size=2000, overlap=200,
+                                         workers=2)
+        next(results)
+        # only the first window of chunks was scanned
+        self.assertLessEqual(len(self.scanned), 4)
+        results.close()
+
+
+class Codec(unittest.TestCase):
+    payload = {'records': [{'id': u'\u2603', 'value': 1.5, 'list': [None]}]}
+
+    def testInstalledCodecsRoundtrip(self):
+        for klass in CODECS:
+            try:
+                codec = klass()
+            except ImportError:
+                continue
+
+            data = codec.dumps(self.payload)
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(codec.loads(data), self.payload)
+            self.assertEqual(JSONCodec().loads(data), self.payload)
+
+    def testGetCodec(self):
+        self.assertIsInstance(get_codec(), JSONCodec)
+        self.assertEqual(get_codec('json').name, 'json')
+        with self.assertRaises(ValueError):
+            get_codec('unknown')
+
+    def testSessionUsesCodec(self):
+        codec = MagicMock(spec=JSONCodec)
+        codec.dumps.return_value = b'{}'
+        codec.loads.return_value = {'records': []}
+
+        session = Session(base_url='http://localhost/', codec=codec)
+        session.request = MagicMock(return_value=MagicMock(status_code=200))
+
+        self.assertEqual(session._query({'class': 'fact'}), [])
+        codec.dumps.assert_called_once_with({'class': 'fact'})
+        kwargs = session.request.call_args[1]
+        self.assertEqual(kwargs['data'], b'{}')
+        self.assertEqual(kwargs['headers']['Content-Type'],
+                         'application/json')
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Stand-in quolab server answering every catalog query with the fact
+    that was queried"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        query = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])))
+        self.server.clients.add(self.client_address)
+        if query.get('type') == 'slow':
+            # the client times out and hangs up in the meantime
+            time.sleep(0.5)
+            self.close_connection = True
+            return
+
+        body = json.dumps({'records': [{
+            'class': query['class'],
+            'type': query['type'],
+            'id': query['id'],
+            'document': {},
+        }]}).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CompressingHandler(QueryHandler):
+    """Stand-in quolab server accepting and sending compressed bodies"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        encoding = self.headers.get('Content-Encoding')
+        if encoding:
+            body = zlib.decompress(body, ENCODINGS[encoding])
+
+        query = json.loads(body)
+        body = json.dumps({'records': [{
+            'class': query['class'],
+            'type': query['type'],
+            'id': query['id'],
+            'document': {'description': 'x' * 10000},
+        }] * 10}).encode('utf-8')
+
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = compress(body, 'gzip')
+            encoding = 'gzip'
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Stand-in quolab server serving server.content as any file. The
+    connection of the first request is dropped after server.drop_after
+    bytes"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        content = self.server.content
+        ranges = self.headers.get('Range')
+        self.server.ranges.append(ranges)
+
+        start = 0
+        if ranges and self.server.honour_range:
+            start = int(ranges[len('bytes='):-1])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+
+        drop_after, self.server.drop_after = self.server.drop_after, None
+        if drop_after is not None:
+            self.wfile.write(content[start:drop_after])
+            self.close_connection = True
+            return
+
+        self.wfile.write(content[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(unittest.TestCase):
+    handler = QueryHandler
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler)
+        self.server.daemon_threads = True
+        self.server.clients = set()
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def query(self, session, i):
+        return session._query({'class': 'fact', 'type': 'url',
+                               'id': 'http://{}.com'.format(i)})
+
+
+class ConcurrentSession(LocalServer):
+    def testConcurrentQueries(self):
+        session = Session(base_url=self.url, pool_maxsize=8, pool_block=True)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(
+                lambda i: self.query(session, i), range(200)))
+
+        self.assertEqual([r[0]['id'] for r in results],
+                         ['http://{}.com'.format(i) for i in range(200)])
+        # connections are reused across requests and threads
+        self.assertLessEqual(len(self.server.clients), 8)
+
+    def testWithoutKeepAlive(self):
+        session = Session(base_url=self.url, keep_alive=False)
+        for i in range(3):
+            self.query(session, i)
+
+        self.assertEqual(len(self.server.clients), 3)
+
+    def testTimeout(self):
+        session = Session(base_url=self.url, timeout=0.1)
+        with self.assertRaises(Timeout):
+            session._query({'class': 'fact', 'type': 'slow', 'id': 'x'})
+
+
+class Throttling(unittest.TestCase):
+    def response(self, status_code, retry_after=None):
+        headers = {'Retry-After': retry_after} if retry_after else {}
+        return MagicMock(status_code=status_code, headers=headers,
+                         content=b'{"records": []}')
+
+    def session(self, *responses, **kwargs):
+        session = Session(base_url='http://localhost/', **kwargs)
+        session.request = MagicMock(side_effect=list(responses))
+        return session
+
+    @patch('pyquo.session.time.sleep')
+    def testQueryIsRetried(self, sleep):
+        session = self.session(self.response(429), self.response(503),
+                               self.response(200), retries=3, backoff=0.1)
+        self.assertEqual(session._query({'class': 'fact'}), [])
+        self.assertEqual(session.request.call_count, 3)
+
+        delays = [call[0][0] for call in sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertTrue(0 <= delays[0] <= 0.1)
+        self.assertTrue(0 <= delays[1] <= 0.2)
+
+    @patch('pyquo.session.time.sleep')
+    def testRetryAfter(self, sleep):
+        session = self.session(self.response(429, '2'), self.response(200),
+                               retries=1)
+        session.http_get('/v1/auth/login')
+        sleep.assert_called_once_with(2.0)
+
+    def testRetryAfterDate(self):
+        res = self.response(429, 'Wed, 21 Oct 2099 07:28:00 GMT')
+        self.assertGreater(retry_after(res), 0)
+
+        res = self.response(429, 'Wed, 21 Oct 2015 07:28:00 GMT')
+        self.assertEqual(retry_after(res), 0)
+
+        res = self.response(429, 'soon')
+        self.assertIsNone(retry_after(res))
+
+    @patch('pyquo.session.time.sleep')
+    def testRetriesExhausted(self, sleep):
+        session = self.session(*[self.response(503)] * 3, retries=2)
+        with self.assertRaises(FetchError) as ctx:
+            session._query({'class': 'fact'})
+
+        self.assertEqual(ctx.exception.status_code, 503)
+        self.assertEqual(session.request.call_count, 3)
+
+    def testImportIsNotRetried(self):
+        session = self.session(self.response(429), retries=3)
+        with self.assertRaises(FetchError):
+            session._import({'fact': []})
+
+        self.assertEqual(session.request.call_count, 1)
+
+    def testAdaptiveConcurrency(self):
+        limiter = RateLimiter(concurrency=8)
+        limiter.acquire()
+        limiter.release(throttled=True)
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(limiter.throttled, 1)
+
+        for i in range(4):
+            limiter.acquire()
+            limiter.release()
+        self.assertTrue(4.5 < limiter.limit < 5)
+
+        for i in range(100):
+            limiter.acquire()
+            limiter.release()
+        self.assertEqual(limiter.limit, 8)
+
+    def testFailedRequestThrottles(self):
+        limiter = RateLimiter(concurrency=8)
+        session = self.session(Timeout(), rate_limiter=limiter)
+        with self.assertRaises(Timeout):
+            session.http_get('/v1/auth/login')
+
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(limiter.throttled, 1)
+        self.assertEqual(limiter.active, 0)
+
+    def testConcurrencyLimit(self):
+        limiter = RateLimiter(concurrency=1)
+        limiter.acquire()
+
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+
+        threading.Thread(target=acquire).start()
+        self.assertFalse(acquired.wait(0.05))
+        limiter.release()
+        self.assertTrue(acquired.wait(1))
+
+    def testTokenBucket(self):
+        limiter = RateLimiter(rate=100, burst=1)
+        start = time.monotonic()
+        for i in range(6):
+            limiter.acquire()
+            limiter.release()
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.045)
+
+    def testContentionUsesOneTokenPerRequest(self):
+        limiter = RateLimiter(rate=1000, burst=1000, concurrency=2)
+        tokens = []
+        wait_time = limiter._wait_time
+
+        def counting_wait_time(now):
+            wait = wait_time(now)
+            if not wait:
+                tokens.append(now)
+            return wait
+
+        limiter._wait_time = counting_wait_time
+
+        def send(i):
+            limiter.acquire()
+            time.sleep(0.002)
+            limiter.release()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(send, range(40)))
+
+        self.assertEqual(len(tokens), 40)
+        self.assertEqual(limiter.active, 0)
+
+    def testRetryAfterPausesLimiter(self):
+        limiter = RateLimiter()
+        session = self.session(self.response(429, '0.1'),
+                               self.response(200), rate_limiter=limiter)
+        with self.assertRaises(FetchError):
+            session._import({'fact': []})
+
+        start = time.monotonic()
+        session._import({'fact': []})
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+
+class Compression(LocalServer):
+    handler = CompressingHandler
+
+    def testCompress(self):
+        for encoding in ENCODINGS:
+            data = b'{"id": "' + b'a' * 5000 + b'"}'
+            self.assertEqual(
+                zlib.decompress(compress(data, encoding), ENCODINGS[encoding]),
+                data)
+
+        with self.assertRaises(ValueError):
+            compress(b'', 'br')
+        with self.assertRaises(ValueError):
+            Session(base_url=self.url, compress='br')
+
+    def testCompressedRequest(self):
+        session = Session(base_url=self.url, compress='gzip')
+        query = {'class': 'fact', 'type': 'url',
+                 'id': ['http://{}.com'.format(i) for i in range(100)]}
+        records = session._query(query)
+        self.assertEqual(records[0]['id'], query['id'])
+
+        stats = session.stats
+        self.assertEqual(stats.requests, 1)
+        self.assertLess(stats.sent, stats.sent_uncompressed)
+        self.assertLess(stats.received, stats.received_uncompressed)
+        self.assertGreater(stats.saved, 0)
+
+    def testThreshold(self):
+        session = Session(base_url=self.url, compress='deflate')
+        self.query(session, 1)
+        self.assertEqual(session.stats.sent, session.stats.sent_uncompressed)
+
+    def testStreamedResponse(self):
+        session = Session(base_url=self.url)
+        records = list(session._query(
+            {'class': 'fact', 'type': 'url', 'id': 'a'}, stream=True))
+        self.assertEqual(len(records), 10)
+        self.assertEqual(len(records[0]['document']['description']), 10000)
+
+
+class FileDownload(LocalServer):
+    handler = FileHandler
+
+    def setUp(self):
+        super(FileDownload, self).setUp()
+        self.content = os.urandom(100000)
+        self.server.content = self.content
+        self.server.ranges = []
+        self.server.drop_after = None
+        self.server.honour_range = True
+        self.session = Session(base_url=self.url)
+        self.file = File(id=hashlib.sha256(self.content).hexdigest())
+
+    def testDownload(self):
+        fp = io.BytesIO()
+        f = self.file.download_to(fp, session=self.session)
+
+        self.assertEqual(fp.getvalue(), self.content)
+        self.assertEqual(f.hashes['md5'],
+                         hashlib.md5(self.content).hexdigest())
+        self.assertEqual(self.server.ranges, [None])
+
+    def testResumeAfterDroppedConnection(self):
+        self.server.drop_after = 30000
+        fp = io.BytesIO()
+        self.file.download_to(fp, chunk_size=1000, session=self.session)
+
+        self.assertEqual(fp.getvalue(), self.content)
+        self.assertEqual(self.server.ranges, [None, 'bytes=30000-'])
+
+    def testServerIgnoringRange(self):
+        self.server.drop_after = 30000
+        self.server.honour_range = False
+        fp = io.BytesIO()
+        self.file.download_to(fp, chunk_size=1000, session=self.session)
+
+        self.assertEqual(fp.getvalue(), self.content)
+
+    def testRetriesExhausted(self):
+        self.server.drop_after = 30000
+        with self.assertRaises(ChunkedEncodingError):
+            self.file.download_to(io.BytesIO(), retries=0,
+                                  session=self.session)
+
+    def testChecksumMismatch(self):
+        with self.assertRaises(ChecksumError):
+            File(id='0' * 64).download_to(io.BytesIO(), session=self.session)
+
+    def testResumePartialFile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sample')
+            with open(path, 'wb') as fp:
+                fp.write(self.content[:40000])
+
+            self.file.download_to(path, resume=True, session=self.session)
+            with open(path, 'rb') as fp:
+                self.assertEqual(fp.read(), self.content)
+
+        self.assertEqual(self.server.ranges, ['bytes=40000-'])
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class AsyncOperations(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        from aiohttp import web
+        from aiohttp.test_utils import TestServer
+
+        self.requests = []
+        app = web.Application()
+        app.router.add_post('/v1/catalog/query', self.query)
+        app.router.add_post('/v1/catalog/import', self.import_)
+        app.router.add_post('/v1/auth/login', self.login)
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+        self.session = AsyncSession(
+            base_url=str(self.server.make_url('/')),
+            auth=TokenAuthenticator('token'))
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.server.close()
+
+    async def query(self, request):
+        from aiohttp import web
+
+        query = await request.json()
+        self.requests.append((request.headers, query))
+        if query.get('class') in ('reference', 'sysref'):
+            records = [{
+                'class': query['class'], 'type': 'contains',
+                'source': File(id='a').serialize,
+                'target': URL(id='b').serialize
+            }]
+        else:
+            ids = query.get('id', 'x')
+            records = [{
+                'class': 'fact', 'type': query.get('type', 'file'), 'id': id,
+                'document': {'size': 12}
+            } for id in (ids if isinstance(ids, list) else [ids])]
+        return web.json_response({'records': records})
+
+    async def import_(self, request):
+        from aiohttp import web
+
+        query = await request.json()
+        return web.json_response(BulkImport._import(query))
+
+    async def login(self, request):
+        from aiohttp import web
+
+        self.logins.append(await request.json())
+        return web.json_response({})
+
+    async def testUserLogin(self):
+        self.logins = []
+        session = AsyncSession(base_url=str(self.server.make_url('/')),
+                               auth=UserAuthenticator('user', 'secret'))
+        async with session:
+            await asyncio.gather(*[File(id=str(i)).aget(session=session)
+                                   for i in range(3)])
+
+        self.assertEqual(self.logins,
+                         [{'username': 'user', 'password': 'secret'}])
+        self.assertEqual(len(self.requests), 3)
+
+    async def testGet(self):
+        facts = [File(id=str(i)) for i in range(20)]
+        await asyncio.gather(*[f.aget(session=self.session) for f in facts])
+
+        self.assertEqual(facts[3].document, {'size': 12})
+        self.assertEqual(len(self.requests), 20)
+        self.assertEqual(self.requests[0][0]['Authorization'],
+                         'Quoken token')
+
+    async def testSaveAndFilter(self):
+        result = await KnownAs(File(id='a'), 'a.exe').asave(
+            session=self.session)
+        self.assertEqual(result.label, 'a.exe')
+
+        results = await File.afilter(session=self.session)
+        self.assertEqual(results, [File(id='x')])
+
+    async def testQuerySetIteration(self):
+        fact = File(id='a', session=self.session)
+        references = fact.references(refs=Reference)
+        targets = [ref.target async for ref in references]
+        self.assertEqual(targets, [URL(id='b')])
+
+        descendants = [f async for f in fact.descendants]
+        self.assertEqual(descendants, [URL(id='b'), URL(id='b')])
+
+    async def testSelectRelated(self):
+        fact = File(id='a', session=self.session)
+        references = fact.references(refs=Reference).select_related()
+        targets = [ref.target async for ref in references]
+
+        self.assertTrue(targets[0]._fetched)
+        self.assertEqual(targets[0].document, {'size': 12})
+        # the reference query and one id list query per fact type
+        self.assertEqual(len(self.requests), 3)
+
+
 class RawQuery(unittest.TestCase):
     def testRawQuery(self):
         response = {"class": "fact", "type": "file", "id": "123"}